@@ -0,0 +1,166 @@
+"""Handles button presses and inline queries on an asyncio event loop.
+
+In this mode the webhook hands callback and inline queries to AsyncPollBot
+instead of the dispatcher. Calls to the Telegram Bot API are awaited on the
+event loop through tornado's non-blocking HTTP client, so any number of them
+can be in flight at once. Database access and rendering are the same blocking
+code PollBot uses, run on a small thread pool, and the poll handlers stay plain
+synchronous functions.
+"""
+import asyncio
+import json
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.httpclient import AsyncHTTPClient
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.utils.helpers import DefaultValue
+
+logger = logging.getLogger(__name__)
+
+API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+
+class AsyncBotApi:
+    """A minimal non-blocking Telegram Bot API client.
+
+    Errors are raised as the python-telegram-bot exceptions the synchronous code
+    already handles.
+    """
+
+    def __init__(self, token, max_clients=100, timeout=10.0, api_url=API_URL):
+        self.token = token
+        self.max_clients = max_clients
+        self.timeout = timeout
+        self.api_url = api_url
+        self.client = None
+
+    async def call(self, method, **params):
+        if self.client is None:
+            # The client belongs to the event loop it is created on.
+            self.client = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+        response = await self.client.fetch(self.api_url.format(token=self.token, method=method),
+                                           method='POST',
+                                           headers={'Content-Type': 'application/json'},
+                                           body=json.dumps(params, default=encode_default),
+                                           request_timeout=self.timeout,
+                                           raise_error=False)
+        if response.body is None:
+            raise TelegramError("{} failed: {}".format(method, response.error))
+
+        data = json.loads(response.body.decode())
+        if data.get('ok'):
+            return data.get('result')
+
+        description = data.get('description', "Unknown error")
+        parameters = data.get('parameters') or {}
+        if 'retry_after' in parameters:
+            raise RetryAfter(parameters['retry_after'])
+        if response.code == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+
+
+def encode_default(obj):
+    # Fields left at their python-telegram-bot default serialize as the default.
+    if isinstance(obj, DefaultValue):
+        return obj.value
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+class AsyncPollBot:
+    def __init__(self, pollbot, api, bot, db_workers=8, buttons=True):
+        self.pollbot = pollbot
+        # With shards, button presses have to go through the dispatcher to the shard router.
+        self.buttons = buttons
+        self.api = api
+        # Only used to look up the bot's own identity if it isn't cached yet.
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='db')
+        self.loop = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.counters = Counter()
+
+    def handles(self, update):
+        if update.callback_query is not None:
+            return self.buttons
+        return update.inline_query is not None
+
+    async def process(self, update):
+        self.loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if update.callback_query is not None:
+                await self.button(update.callback_query)
+            elif update.inline_query is not None:
+                await self.inline_query(update.inline_query)
+            self.counters['processed'] += 1
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.warning('Update "%s" caused error "%s"', update, e)
+        finally:
+            self.in_flight -= 1
+
+    async def button(self, query):
+        metrics = self.pollbot.metrics
+
+        def handle_button():
+            # The database part is timed as the request, the awaited API calls as phases of their own.
+            with metrics.request('button'):
+                return self.pollbot.handle_button(query, self.bot)
+
+        answer, vote, followup = await self.loop.run_in_executor(self.executor, handle_button)
+        poll_type = self.pollbot.get_handler(vote[0]).__name__ if vote is not None else None
+        with metrics.phase('telegram', request='button', poll_type=poll_type):
+            if answer is None:
+                await self.api.call('answerCallbackQuery', callback_query_id=query.id)
+            else:
+                await self.api.call('answerCallbackQuery', callback_query_id=query.id, text=answer)
+        if followup is not None:
+            # Exports are rare, they're sent through the synchronous bot on a database thread.
+            await self.loop.run_in_executor(self.executor, followup)
+        if vote is None:
+            return
+        poll, edit_kwargs, message_key, include_publish_button = vote
+
+        def send(text, reply_markup):
+            # Rendered on a scheduler or database thread, the edit itself is awaited on the
+            # event loop. The scheduler learns of rate limits through the returned future.
+            return asyncio.run_coroutine_threadsafe(
+                self.api.call('editMessageText',
+                              text=text,
+                              parse_mode='Markdown',
+                              reply_markup=reply_markup.to_dict(),
+                              **edit_kwargs),
+                self.loop)
+
+        await self.loop.run_in_executor(self.executor, self.pollbot.schedule_edit,
+                                        poll, message_key, include_publish_button, send)
+
+    async def inline_query(self, inline_query):
+        metrics = self.pollbot.metrics
+
+        def find_inline_results():
+            with metrics.request('inline_query'):
+                return self.pollbot.find_inline_results(inline_query)
+
+        inline_results, next_offset = await self.loop.run_in_executor(self.executor, find_inline_results)
+        if not inline_results:
+            await self.api.call('answerInlineQuery',
+                                inline_query_id=inline_query.id,
+                                results=[],
+                                switch_pm_text="Create a new poll",
+                                switch_pm_parameter="start",
+                                is_personal=True)
+            return
+        await self.api.call('answerInlineQuery',
+                            inline_query_id=inline_query.id,
+                            results=[result.to_dict() for result in inline_results],
+                            next_offset=next_offset,
+                            is_personal=True)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
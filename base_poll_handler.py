@@ -20,6 +20,36 @@ def handle_vote(votes, user, name, callback_data):
     pass
 
 
+def accepts_press(callback_data):
+    # Whether the callback data could have come from one of the poll type's buttons.
+    return is_option_press(callback_data)
+
+
+def is_option_press(callback_data, special=()):
+    # A press of an option button, or of one of the special buttons such as "C" to clear the vote.
+    index = callback_data.get('i')
+    return set(callback_data) == {'i', 'id'} and (isinstance(index, int) or index in special)
+
+
+def selected_options(vote):
+    # Poll types that keep a per-option tally return the indices a vote counts towards.
+    return None
+
+
+# Whether selected_options() always returns exactly one index, so a tally counts as many votes as voters.
+single_choice = False
+
+
+def export_vote(vote):
+    # The rows a vote is exported as, one per option it picks, with the keys option, rank, answer and name.
+    return []
+
+
+def update_voter(poll, user, name):
+    # Called after every vote. Poll types that show who voted keep the voter's name.
+    pass
+
+
 def get_confirmation_message(poll, user):
     return "Nothing happened."
 
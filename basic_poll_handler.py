@@ -1,7 +1,9 @@
 from base_poll_handler import *
+import vote_tally
 
 name = "Basic poll"
 desc = "A straightforward first-past-the-post poll."
+single_choice = True
 
 
 def options(poll):
@@ -46,5 +48,16 @@ def get_confirmation_message(poll, user):
     return "Your vote was removed."
 
 
+def selected_options(vote):
+    return [] if vote is None else [vote]
+
+
+def export_vote(vote):
+    return [{'option': vote}]
+
+
 def num_votes(poll, i):
+    tallied = vote_tally.count(poll, i)
+    if tallied is not None:
+        return tallied
     return list(poll['votes'].values()).count(i) if 'votes' in poll else 0
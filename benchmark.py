@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the poll handlers and the button press path.
+
+For every poll type in POLL_HANDLERS, synthetic polls with N options and M voters
+are generated and options(), evaluation() and handle_vote() are timed. The whole
+button path is driven against a fake bot and a temporary SQLite database.
+
+The results are written as a JSON report. Pass a previous report as baseline to
+flag every measurement that got slower by more than the threshold:
+
+    python benchmark.py -o before.json
+    python benchmark.py -b before.json
+
+With --verify, the election engines are instead checked against the reference
+implementations in election_reference.py on random ballots.
+"""
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import callback_data
+import database
+import election_reference
+import instant_runoff_poll_handler
+import stv_poll_handler
+import storage
+import tie_break_instant_runoff_poll_handler
+import vote_storage
+import vote_tally
+from pollbot import PollBot, POLL_HANDLERS
+
+BENCHMARK_META = {
+    'text': "Benchmark description",
+    'numopts': '2',
+}
+
+BOT_ID = 1
+BENCHMARK_POLL_ID = '8f0b2a4e-3c61-4d1e-9a57-0c2e7d4b6f13'
+
+
+class FakeBot:
+    def __init__(self):
+        self.edits = 0
+
+    def get_me(self):
+        return SimpleNamespace(id=BOT_ID, username='benchmark_bot')
+
+    def edit_message_text(self, **kwargs):
+        self.edits += 1
+
+
+def make_poll(polltype, num_options, poll_id=BENCHMARK_POLL_ID):
+    handler = POLL_HANDLERS[polltype]
+    num_options = min(num_options, handler.max_options)
+    return {
+        'poll_id': poll_id,
+        'title': "Benchmark poll",
+        'type': polltype,
+        'options': [{'text': "Option {}".format(i), 'index': i} for i in range(num_options)],
+        'meta': dict(BENCHMARK_META),
+        'votes': {},
+    }
+
+
+def button_callbacks(poll):
+    handler = POLL_HANDLERS[poll['type']]
+    template = dict(poll, votes={})
+    template.pop('tally', None)
+    return [item['callback_data'] for row in handler.options(template) for item in row]
+
+
+def make_clicks(poll, num_voters, rng):
+    """Return a list of (user, name, callback_data) button presses by num_voters voters."""
+    callbacks = button_callbacks(poll)
+    clicks = []
+    for voter in range(num_voters):
+        user = str(100000 + voter)
+        for _ in range(rng.randint(1, 3)):
+            clicks.append((user, "Voter {}".format(voter), dict(rng.choice(callbacks))))
+    return clicks
+
+
+def fill_poll(poll, num_voters, rng):
+    handler = POLL_HANDLERS[poll['type']]
+    for user, name, callback_data in make_clicks(poll, num_voters, rng):
+        handler.handle_vote(poll['votes'], user, name, callback_data)
+        handler.update_voter(poll, user, name)
+    vote_tally.ensure(poll, handler)
+    return poll
+
+
+def measure(func, min_time=0.2, max_runs=1000):
+    """Return the best time of several runs of func, in seconds."""
+    best = float('inf')
+    total = 0.0
+    runs = 0
+    while runs < max_runs and (runs < 3 or total < min_time):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best
+
+
+def bench_handlers(option_counts, voter_counts, seed):
+    results = {}
+    for polltype, handler in POLL_HANDLERS.items():
+        for num_options in option_counts:
+            for num_voters in voter_counts:
+                rng = random.Random(seed)
+                poll = fill_poll(make_poll(polltype, num_options), num_voters, rng)
+                label = "{}/n={}/m={}".format(handler.__name__, num_options, num_voters)
+
+                results['options/' + label] = measure(lambda: handler.options(poll))
+                results['evaluation/' + label] = measure(lambda: handler.evaluation(poll))
+
+                clicks = make_clicks(poll, num_voters, rng)
+
+                def vote_all():
+                    votes = json.loads(json.dumps(poll['votes']))
+                    for user, name, callback_data in clicks:
+                        handler.handle_vote(votes, user, name, callback_data)
+
+                results['handle_vote/' + label] = measure(vote_all, max_runs=20) / max(len(clicks), 1)
+                print("{:<70} done".format(label), file=sys.stderr)
+    return results
+
+
+def click_update(user, name, data, inline_message_id):
+    query = SimpleNamespace(
+        data=data,
+        from_user=SimpleNamespace(id=int(user), first_name=name),
+        message=None,
+        inline_message_id=inline_message_id,
+        answer=lambda *args, **kwargs: None,
+    )
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user)
+
+
+def bench_button(option_counts, voter_counts, seed, storage_name='json'):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='pollbot-benchmark-')
+    try:
+        for polltype, handler in POLL_HANDLERS.items():
+            for num_options in option_counts:
+                for num_voters in voter_counts:
+                    bot = PollBot()
+                    bot.storage = storage.SqliteStorage(database.connect_sqlite(
+                        os.path.join(workdir, '{}-{}-{}.db'.format(polltype, num_options, num_voters))))
+                    bot.storage.migrate()
+                    bot.vote_storage = vote_storage.VOTE_STORAGES[storage_name]()
+                    bot.render_scheduler.interval = 0
+                    fake_bot = FakeBot()
+                    context = SimpleNamespace(bot=fake_bot, user_data={})
+
+                    poll = make_poll(polltype, num_options)
+                    template = dict(poll)
+                    template.pop('votes')
+                    bot.storage.create_template(bot.serialize(template))
+
+                    clicks = make_clicks(poll, num_voters, random.Random(seed))
+                    updates = [click_update(user, name, callback_data.encode(item, poll['poll_id']), 'benchmark')
+                               for user, name, item in clicks]
+
+                    start = time.perf_counter()
+                    for update in updates:
+                        bot.button(update, context)
+                    bot.render_scheduler.flush_all()
+                    elapsed = time.perf_counter() - start
+
+                    label = "{}/n={}/m={}".format(handler.__name__, num_options, num_voters)
+                    results['button/' + label] = elapsed / max(len(updates), 1)
+                    bot.storage.close()
+                    print("{:<70} done".format('button ' + label), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def random_ballots(rng, candidates, num_voters):
+    ballots = []
+    for _ in range(num_voters):
+        ranking = rng.sample(candidates, len(candidates))
+        ballots.append(ranking[:rng.randint(1, len(candidates))])
+    return ballots
+
+
+def random_ranked_poll(rng):
+    num_options = rng.randint(1, 8)
+    poll = {
+        'poll_id': 'verify',
+        'title': "Verification poll",
+        'options': [{'text': "Option {}".format(i), 'index': i} for i in range(num_options)],
+        'meta': dict(BENCHMARK_META),
+    }
+    # Few voters make ties, which exercise the interesting code paths, much more likely.
+    num_voters = rng.choice([rng.randint(1, 6), rng.randint(1, 40), rng.randint(1, 300)])
+    candidates = [opt['index'] for opt in poll['options']]
+    poll['votes'] = {str(voter): ballot for voter, ballot in enumerate(random_ballots(rng, candidates, num_voters))}
+    return poll
+
+
+def verify_engines(trials, seed):
+    """Compare the election engines with the reference implementations, return the mismatches."""
+    rng = random.Random(seed)
+    mismatches = []
+    for trial in range(trials):
+        poll = random_ranked_poll(rng)
+        candidates = [opt['index'] for opt in poll['options']]
+        ballots = list(poll['votes'].values())
+
+        expected = election_reference.run_election(list(candidates), ballots)
+        actual = instant_runoff_poll_handler.run_election(list(candidates), ballots)
+        if expected != actual:
+            mismatches.append(('instant_runoff', trial, poll, expected, actual))
+
+        expected = election_reference.tie_break_evaluation(poll)
+        actual = tie_break_instant_runoff_poll_handler.evaluation(poll)
+        if expected != actual:
+            mismatches.append(('tie_break_instant_runoff', trial, poll, expected, actual))
+
+        poll['meta']['numopts'] = str(rng.randint(1, len(candidates)))
+        expected = election_reference.stv_evaluation(poll)
+        actual = stv_poll_handler.evaluation(poll)
+        if expected != actual:
+            mismatches.append(('stv', trial, poll, expected, actual))
+    return mismatches
+
+
+def compare(results, baseline, threshold):
+    """Return (name, baseline, current, ratio) for every measurement that regressed."""
+    regressions = []
+    for name, value in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+        ratio = value / old
+        if ratio > threshold:
+            regressions.append((name, old, value, ratio))
+    return regressions
+
+
+def main(opts):
+    logging.getLogger().setLevel(logging.WARNING)
+    if opts.verify:
+        mismatches = verify_engines(opts.verify, opts.seed)
+        for engine, trial, poll, expected, actual in mismatches[:10]:
+            print("MISMATCH {} in trial {}: expected {!r}, got {!r}\n  votes: {}".format(
+                engine, trial, expected, actual, json.dumps(poll['votes'])))
+        print("{} mismatches in {} trials".format(len(mismatches), opts.verify))
+        return 1 if mismatches else 0
+
+    option_counts = [int(n) for n in opts.options.split(',')]
+    voter_counts = [int(m) for m in opts.voters.split(',')]
+    button_voter_counts = [int(m) for m in opts.button_voters.split(',')]
+
+    results = {}
+    results.update(bench_handlers(option_counts, voter_counts, opts.seed))
+    if not opts.skip_button:
+        results.update(bench_button(option_counts, button_voter_counts, opts.seed, opts.vote_storage))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': opts.seed,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+    if opts.output:
+        with open(opts.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+    else:
+        for name, value in sorted(results.items()):
+            print("{:<80} {:>12.1f} us".format(name, value * 1e6))
+
+    if opts.baseline:
+        with open(opts.baseline, 'r') as basefile:
+            baseline = json.load(basefile)['results']
+        regressions = compare(results, baseline, opts.threshold)
+        for name, old, new, ratio in regressions:
+            print("REGRESSION {}: {:.1f} us -> {:.1f} us ({:.2f}x)".format(name, old * 1e6, new * 1e6, ratio))
+        if regressions:
+            return 1
+        print("No regressions against {} (threshold {:.2f}x)".format(opts.baseline, opts.threshold))
+    return 0
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-n', '--options', dest='options', default='4,10', type='string',
+                      help="Comma separated numbers of poll options")
+    parser.add_option('-m', '--voters', dest='voters', default='10,100,1000', type='string',
+                      help="Comma separated numbers of voters for the handler benchmarks")
+    parser.add_option('--button-voters', dest='button_voters', default='100', type='string',
+                      help="Comma separated numbers of voters for the button benchmarks")
+    parser.add_option('--skip-button', dest='skip_button', action='store_true', default=False,
+                      help="Don't benchmark the button path")
+    parser.add_option('--vote-storage', dest='vote_storage', default='json', type='string',
+                      help="Vote storage used by the button benchmarks")
+    parser.add_option('--verify', dest='verify', default=0, type='int',
+                      help="Check the election engines against the reference implementations in this many random trials")
+    parser.add_option('-s', '--seed', dest='seed', default=1, type='int', help="Random seed")
+    parser.add_option('-o', '--output', dest='output', default=None, type='string',
+                      help="Write the JSON report to this file")
+    parser.add_option('-b', '--baseline', dest='baseline', default=None, type='string',
+                      help="Compare against this earlier JSON report")
+    parser.add_option('-t', '--threshold', dest='threshold', default=1.25, type='float',
+                      help="Slowdown factor that counts as a regression")
+    (opts, args) = parser.parse_args()
+    sys.exit(main(opts))
@@ -0,0 +1,165 @@
+"""The callback data sent with poll buttons.
+
+Telegram allows at most 64 bytes of callback data per button. Buttons used to
+carry the JSON of the poll handler's callback dict plus the poll id, in which
+the 36 characters of the poll's UUID take up most of the space. Now they're
+packed into a fixed format instead:
+
+    1  o  hQ0d1LAuTYWo6_3k1cX2Ag  7
+    |  |  |                       `- argument in base 36 (optional)
+    |  |  `- poll id: the UUID's 16 bytes in unpadded url-safe base64
+    |  `- action, see ACTIONS
+    `- format version
+
+Polls whose id is not a UUID, and buttons sent before the change, use JSON,
+which decode() still accepts. Anything else is rejected with
+InvalidCallbackData before any poll is looked up, and check_options() rejects
+options the poll doesn't have before its handler sees the press.
+"""
+import base64
+import json
+import re
+import uuid
+from functools import lru_cache
+
+VERSION = '1'
+MAX_LENGTH = 64
+KEY_LENGTH = 22
+
+# action: (callback dict key, fixed value or None for the base 36 argument)
+ACTIONS = {
+    'o': ('i', None),
+    'c': ('i', 'C'),
+    'n': ('i', 'N'),
+    'm': ('m', None),
+    't': ('i', None),
+    'x': ('a', 'x'),
+}
+
+ARGUMENT_PATTERN = re.compile(r'[0-9a-z]{1,8}\Z')
+KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{22}\Z')
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class InvalidCallbackData(ValueError):
+    pass
+
+
+def to_base36(number):
+    if number == 0:
+        return '0'
+    digits = []
+    while number:
+        number, digit = divmod(number, 36)
+        digits.append(DIGITS[digit])
+    return ''.join(reversed(digits))
+
+
+@lru_cache(maxsize=4096)
+def poll_key(poll_id):
+    """Return the packed form of a poll id, or None if it isn't a UUID."""
+    try:
+        parsed = uuid.UUID(poll_id)
+    except ValueError:
+        return None
+    if str(parsed) != poll_id:
+        return None
+    return base64.urlsafe_b64encode(parsed.bytes).decode('ascii').rstrip('=')
+
+
+@lru_cache(maxsize=4096)
+def poll_id_from_key(key):
+    if not KEY_PATTERN.match(key):
+        raise InvalidCallbackData("Malformed poll key {!r}".format(key))
+    return str(uuid.UUID(bytes=base64.urlsafe_b64decode(key + '==')))
+
+
+def encode_action(item):
+    """Return the action and argument for a callback dict produced by a poll handler."""
+    if item.get('a') == 'x':
+        return 'x', None
+    if 'm' in item:
+        return 'm', item['m']
+    if item.get('a') == 't':
+        return 't', item['i']
+    if item['i'] == 'C':
+        return 'c', None
+    if item['i'] == 'N':
+        return 'n', None
+    return 'o', item['i']
+
+
+def encode(item, poll_id):
+    """Return the callback data of a button, given the poll handler's callback dict."""
+    key = poll_key(poll_id)
+    action, argument = encode_action(item)
+    if key is None or not (argument is None or isinstance(argument, int) and argument >= 0):
+        data = json.dumps(dict(item, id=poll_id), separators=(',', ':'))
+    else:
+        data = VERSION + action + key + ('' if argument is None else to_base36(argument))
+    if len(data.encode('utf-8')) > MAX_LENGTH:
+        raise ValueError("Callback data {!r} is longer than {} bytes".format(data, MAX_LENGTH))
+    return data
+
+
+def decode(data):
+    """Return the callback dict of a pressed button, including the poll's 'id'."""
+    if not data or len(data) > MAX_LENGTH:
+        raise InvalidCallbackData("Callback data of length {}".format(len(data or '')))
+    if data[0] == '{':
+        return decode_json(data)
+    if data[0] != VERSION:
+        raise InvalidCallbackData("Unknown callback data version {!r}".format(data[0]))
+
+    action = ACTIONS.get(data[1:2])
+    if action is None:
+        raise InvalidCallbackData("Unknown callback action {!r}".format(data[1:2]))
+    name, value = action
+    argument = data[2 + KEY_LENGTH:]
+    if value is None:
+        if not ARGUMENT_PATTERN.match(argument):
+            raise InvalidCallbackData("Malformed callback argument {!r}".format(argument))
+        value = int(argument, 36)
+    elif argument:
+        raise InvalidCallbackData("Unexpected callback argument {!r}".format(argument))
+
+    result = {name: value, 'id': poll_id_from_key(data[2:2 + KEY_LENGTH])}
+    if data[1] == 't':
+        result['a'] = 't'
+    return result
+
+
+def decode_json(data):
+    # The format buttons had before, and still have for polls without a UUID.
+    try:
+        result = json.loads(data)
+    except ValueError:
+        raise InvalidCallbackData("Malformed JSON callback data")
+    if not isinstance(result, dict) or not isinstance(result.get('id'), str) \
+            or not ('i' in result or 'm' in result or 'a' in result):
+        raise InvalidCallbackData("Incomplete JSON callback data")
+    if 'i' in result and not (is_index(result['i']) or result['i'] in ('C', 'N')
+                              or isinstance(result['i'], list) and all(is_index(i) for i in result['i'])):
+        raise InvalidCallbackData("Malformed option {!r}".format(result['i']))
+    if 'm' in result and not is_index(result['m']):
+        raise InvalidCallbackData("Malformed option mask {!r}".format(result['m']))
+    if 'a' in result and not (result['a'] == 'x' or result['a'] == 't' and is_index(result.get('i'))):
+        raise InvalidCallbackData("Malformed action {!r}".format(result['a']))
+    return result
+
+
+def is_index(value):
+    # bool is an int too, but no button ever sent one.
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def check_options(data, num_options):
+    """Raise InvalidCallbackData if the callback dict refers to options a poll with num_options doesn't have."""
+    if 'm' in data:
+        if data['m'] >= 1 << num_options:
+            raise InvalidCallbackData("Option mask {} on a poll with {} options".format(data['m'], num_options))
+        return
+    indices = data.get('i')
+    for index in indices if isinstance(indices, list) else [indices]:
+        if is_index(index) and index >= num_options:
+            raise InvalidCallbackData("Option {} on a poll with {} options".format(index, num_options))
@@ -10,11 +10,4 @@ desc = "Like open poll, but lets you add a custom text to the poll message."
 def evaluation(poll):
     message = poll['meta']['text']
     message += "\n"
-    for i, option in enumerate(poll['options']):
-        message += "\n"
-        message += "*{}: {}*".format(option['text'], num_votes(poll, i))
-        users = get_users_voting_for(poll, option)
-        for user in users:
-            message += "\n "
-            message += user
-    return message
+    return message + list_voters(poll, num_votes)
@@ -22,6 +22,9 @@ def register_extra_config(text, meta):
 
 
 def num_votes(poll, i):
+    tallied = vote_tally.count(poll, i)
+    if tallied is not None:
+        return tallied
     return list(poll['votes'].values()).count(i) if 'votes' in poll else 0
 
 
@@ -0,0 +1,90 @@
+"""Opens the poll database with the connection settings from the config file.
+
+Every thread keeps its own connection (dataset hands them out per thread), and
+the connection pool grows with the number of threads instead of making the
+extra ones wait. SQLite runs in WAL mode by default, so inline queries reading
+polls don't block button presses writing votes, and writers wait for each
+other for up to busy_timeout milliseconds instead of failing right away.
+Database servers such as PostgreSQL are connected to by URL.
+"""
+import logging
+
+import dataset
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+SQLITE_DEFAULTS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': None,
+    'cache_size': None,
+    'pool_size': 16,
+}
+
+JOURNAL_MODES = {'delete', 'truncate', 'persist', 'memory', 'wal', 'off'}
+SYNCHRONOUS_LEVELS = {'off', 'normal', 'full', 'extra'}
+PRAGMAS = ['journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size']
+
+
+def sqlite_pragmas(settings):
+    """Return the PRAGMA statements every new connection runs for these settings."""
+    journal_mode = str(settings['journal_mode']).lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError("Unknown SQLite journal_mode {!r}".format(settings['journal_mode']))
+    synchronous = str(settings['synchronous']).lower()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError("Unknown SQLite synchronous level {!r}".format(settings['synchronous']))
+
+    statements = [
+        'PRAGMA busy_timeout = {:d}'.format(int(settings['busy_timeout'])),
+        'PRAGMA journal_mode = {}'.format(journal_mode),
+        'PRAGMA synchronous = {}'.format(synchronous),
+    ]
+    for pragma in ('mmap_size', 'cache_size'):
+        if settings[pragma] is not None:
+            statements.append('PRAGMA {} = {:d}'.format(pragma, int(settings[pragma])))
+    return statements
+
+
+def connect_sqlite(path, settings=None):
+    settings = dict(SQLITE_DEFAULTS, **(settings or {}))
+    statements = sqlite_pragmas(settings)
+
+    db = dataset.connect('sqlite:///{}'.format(path), engine_kwargs={
+        'pool_size': int(settings['pool_size']),
+        # Connections stay with their thread, so threads beyond pool_size get their own too.
+        'max_overflow': -1,
+    })
+
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    event.listen(db.engine, 'connect', configure)
+    return db
+
+
+def connect_url(url, pool_size=16):
+    """Connect to a database server, such as PostgreSQL, by its SQLAlchemy URL."""
+    return dataset.connect(url, engine_kwargs={
+        'pool_size': int(pool_size),
+        'max_overflow': -1,
+        # Connections to a server can be dropped while they sit in the pool.
+        'pool_pre_ping': True,
+    })
+
+
+def log_settings(db):
+    """Log the settings the database connection actually ended up with."""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    effective = {}
+    for pragma in PRAGMAS:
+        row = next(iter(db.query('PRAGMA {}'.format(pragma))))
+        effective[pragma] = list(row.values())[0]
+    logger.info("SQLite settings: %s", ', '.join('{}={}'.format(k, v) for k, v in effective.items()))
+    return effective
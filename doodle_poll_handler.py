@@ -1,19 +1,22 @@
 from base_poll_handler import *
+import vote_storage
 
 name = "Doodle"
 desc = "Lets you pick the preferred out of multiple options, with yes-no-ifneedbe answers"
 
 
 def options(poll):
+    counts = aggregate(poll)
     buttons = [[{
         'text': "Clear my votes",
         'callback_data': {'i': "C"}
     }]]
 
     for opt in poll['options']:
-        total = num_votes_on_option(poll, opt['index'])
-        yes = num_yes_on_option(poll, opt['index'])
-        inb = num_inb_on_option(poll, opt['index'])
+        string_index = str(opt['index'])
+        total = counts['total'].get(string_index, 0)
+        yes = counts['yes'].get(string_index, 0)
+        inb = counts['inb'].get(string_index, 0)
         buttons.append([{
             'text': "{}{}{}{}{}".format(opt['text'],
                                     " - " if total > 0 else "",
@@ -23,7 +26,7 @@ def options(poll):
             'callback_data': {'i': opt['index']}
         }])
 
-    nopes = num_cant_make_it(poll)
+    nopes = counts['nope']
     buttons.append([{
         'text': "Can't make it{}{}".format(
             " - " if nopes > 0 else "",
@@ -35,34 +38,71 @@ def options(poll):
 
 
 def evaluation(poll):
+    counts = aggregate(poll)
     message = ""
-    best_opts = find_best(poll)
-    num_votes = len(poll.get('votes', {}))
+    best_opts = find_best(poll, counts)
     for option in poll['options']:
+        string_index = str(option['index'])
         message += "\n"
         if option['index'] in best_opts:
             message += "> "
-        message += "{}: {} yes".format(option['text'], num_yes_on_option(poll, option['index']))
-        inb = num_inb_on_option(poll, option['index'])
+        message += "{}: {} yes".format(option['text'], counts['yes'].get(string_index, 0))
+        inb = counts['inb'].get(string_index, 0)
         if inb > 0:
             message += ", {} if need be".format(inb)
 
-    message += "\n\n{} people voted so far".format(num_votes)
+    message += "\n\n{} people voted so far".format(counts['voters'])
     return message
 
 
-def find_best(poll):
+def aggregate(poll):
+    """Count yes, if need be and total answers per option and the can't-make-its in one pass over the votes.
+
+    Per-option counts are keyed by the option index as a string, like the votes themselves.
+    """
+    yes = {}
+    inb = {}
+    total = {}
+    nope = 0
+    voters = 0
+
+    votes = poll.get('votes', {})
+    for cast_vote, num in vote_storage.grouped_payloads(votes):
+        voters += num
+        if cast_vote == "nope":
+            nope += num
+            continue
+        for string_index, answer in cast_vote.items():
+            total[string_index] = total.get(string_index, 0) + num
+            if answer == 'y':
+                yes[string_index] = yes.get(string_index, 0) + num
+            elif answer == 'i':
+                inb[string_index] = inb.get(string_index, 0) + num
+
+    return {
+        'yes': yes,
+        'inb': inb,
+        'total': total,
+        'nope': nope,
+        'voters': voters,
+    }
+
+
+def find_best(poll, counts=None):
     opts = poll['options']
     votes = poll.get('votes')
 
     if not votes:
         return []
 
+    if counts is None:
+        counts = aggregate(poll)
+
     best = []
     max_votes = 0
 
     for opt in opts:
-        num = num_votes_on_option(poll, opt['index'])
+        num = counts['total'].get(str(opt['index']), 0)
         if num > max_votes:
             best = [opt]
             max_votes = num
@@ -72,7 +112,7 @@ def find_best(poll):
     min_inb = 9999999
     best_after_inb = []
     for opt in best:
-        num = num_inb_on_option(poll, opt['index'])
+        num = counts['inb'].get(str(opt['index']), 0)
         if num < min_inb:
             best_after_inb = [opt['index']]
             min_inb = num
@@ -82,6 +122,10 @@ def find_best(poll):
     return best_after_inb
 
 
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C', 'N'))
+
+
 def handle_vote(votes, user, name, callback_data):
     old_vote = None
     if user in votes:
@@ -108,6 +152,14 @@ def handle_vote(votes, user, name, callback_data):
         votes[user] = {pressed: "y"}
 
 
+def export_vote(vote):
+    if vote == "nope":
+        return [{'answer': "no"}]
+    answers = {"y": "yes", "i": "if need be"}
+    return [{'option': int(index), 'answer': answers[answer]}
+            for index, answer in sorted(vote.items(), key=lambda item: int(item[0]))]
+
+
 def get_confirmation_message(poll, user):
     votes = poll.get('votes')
     if user in votes:
@@ -116,62 +168,16 @@ def get_confirmation_message(poll, user):
 
 
 def num_votes_on_option(poll, index):
-    if 'votes' not in poll:
-        return 0
-    votes = poll['votes']
-
-    string_index = str(index)
-
-    num = 0
-    for cast_vote in votes.values():
-        if cast_vote == "nope":
-            continue
-        if string_index in cast_vote.keys():
-            num += 1
-    return num
+    return aggregate(poll)['total'].get(str(index), 0)
 
 
 def num_yes_on_option(poll, index):
-    if 'votes' not in poll:
-        return 0
-    votes = poll['votes']
-
-    string_index = str(index)
-
-    num = 0
-    for cast_vote in votes.values():
-        if cast_vote == "nope":
-            continue
-        if string_index in cast_vote.keys():
-            if cast_vote[string_index] == 'y':
-                num += 1
-    return num
+    return aggregate(poll)['yes'].get(str(index), 0)
 
 
 def num_inb_on_option(poll, index):
-    if 'votes' not in poll:
-        return 0
-    votes = poll['votes']
-
-    string_index = str(index)
-
-    num = 0
-    for cast_vote in votes.values():
-        if cast_vote == "nope":
-            continue
-        if string_index in cast_vote.keys():
-            if cast_vote[string_index] == 'i':
-                num += 1
-    return num
+    return aggregate(poll)['inb'].get(str(index), 0)
 
 
 def num_cant_make_it(poll):
-    if 'votes' not in poll:
-        return 0
-    votes = poll['votes']
-
-    num = 0
-    for cast_vote in votes.values():
-        if cast_vote == "nope":
-            num += 1
-    return num
+    return aggregate(poll)['nope']
@@ -0,0 +1,317 @@
+"""Reference implementations of the election counting code.
+
+These are the original, straightforward versions of the counting engines that
+the poll handlers have since replaced with faster ones. They are kept unchanged
+so that ``benchmark.py --verify`` can check the engines against them on random
+polls. Don't use them in the bot.
+"""
+import math
+
+from tie_break_instant_runoff_poll_handler import get_votes_per_rank, get_option_name_by_index
+
+
+# Instant runoff (instant_runoff_poll_handler)
+
+def run_election(candidates, votes, skip_index=0):
+
+    if not any([v[skip_index:] for v in votes]):
+        # No votes left - it's a tie.
+        return candidates
+
+    elected = None
+    quota = math.floor(len(votes) / 2) + 1
+
+    while elected is None:
+        counts = count_votes(votes, candidates, skip_index)
+        max_votes = max(counts)
+        if max_votes >= quota:
+            # Somebody has hit the quota, elect them:
+            elected = [candidates[i] for i, count in enumerate(counts) if count == max_votes]
+        else:
+            min_votes = min(counts)
+            old_candidates = list(candidates)
+            # eliminate all candidates with lowest count:
+            delete_pls = []
+            for i, count in enumerate(counts):
+                if count == min_votes:
+                    delete_pls.append(candidates[i])
+            for candidate in delete_pls:
+                candidates.remove(candidate)
+            if not candidates:
+                # The last remaining candidates were eliminated at the same time. We have a tie!
+                # Battle these remaining candidates:
+                return run_election(old_candidates, votes, skip_index=skip_index + 1)
+    return elected
+
+
+def count_votes(votes, candidates, skip_index):
+    counts = [0] * len(candidates)
+    for vote in votes:
+        vote_counted = False
+        for preference in vote:
+            if preference in candidates and not vote_counted:
+                counts[candidates.index(preference)] += 1
+                vote_counted = True
+    return counts
+
+
+
+# Instant runoff with fallback tie-breaking (tie_break_instant_runoff_poll_handler)
+
+def tie_break_evaluation(poll):
+    votes = poll.get('votes', {})
+    candidates = [opt['index'] for opt in poll['options']]
+
+    if votes:
+        elected = None
+        quota = math.floor(len(votes) / 2) + 1
+
+        while elected is None:
+            counts = tie_break_count_votes(votes, candidates)
+            max_votes = max(counts)
+            if max_votes >= quota:
+                # Somebody has hit the quota, elect them:
+                elected = [candidates[i] for i, count in enumerate(counts) if count == max_votes]
+            else:
+                min_votes = min(counts)
+                old_candidates = list(candidates)
+                # eliminate all candidates with lowest count:
+                delete_pls = []
+                for i, count in enumerate(counts):
+                    if count == min_votes:
+                        delete_pls.append(candidates[i])
+                for candidate in delete_pls:
+                    candidates.remove(candidate)
+                if not candidates:
+                    # The last remaining candidates were eliminated at the same time. We have a tie!
+                    candidates = old_candidates
+                    # Tiebreak fallback solution
+                    tiered_votes = {}
+                    for candidate in old_candidates:
+                        tiered_vote = get_votes_per_rank(poll, candidate)
+                        tiered_votes[candidate] = tiered_vote
+
+                    for i in range(1, len(poll['options']) + 1):
+                        # To resolve the tie, continually calculate prefix sums of our the votes per rank
+                        max_candidate_vote = 0
+                        current_best_candidates = []
+                        for candidate, vote in tiered_votes.items():
+                            prefix_sum = sum(vote[:i])
+                            # Keep all candidates with highest prefix sum
+                            if max_candidate_vote == prefix_sum:
+                                current_best_candidates.append(candidate)
+                            elif max_candidate_vote < prefix_sum:
+                                max_candidate_vote = prefix_sum
+                                current_best_candidates = [candidate]
+
+                        # Throw out all candidates that don't have highest prefix sum anymore
+                        to_remove = []
+                        for candidate, vote in tiered_votes.items():
+                            if candidate not in current_best_candidates:
+                                to_remove.append(candidate)
+                        for candidate in to_remove:
+                            tiered_votes.pop(candidate)
+
+                        if len(current_best_candidates) == 1:
+                            # we have a winner!
+                            elected = current_best_candidates
+                            break
+
+                    if not elected:
+                        # We have a true tie
+                        elected = current_best_candidates
+
+        elected_names = [get_option_name_by_index(poll, el) for el in elected]
+        message = "{}: {}".format(
+            "Current winner" if len(elected_names) == 1 else "We have a tie",
+            ",".join(elected_names)
+        )
+    else:
+        message = "There are currently no votes."
+
+    num_votes = len(poll.get('votes', {}))
+
+    body = "This is an instant runoff poll with tie breaking. \n" \
+           "You define an order of preference for the available options " \
+           "by clicking on them in that order. For evaluation, the lowest " \
+           "ranking candidate is eliminated until there is a clear winner. \n" \
+           "This poll uses a fall-back tie-breaking algorithm, meaning that it " \
+           "will try extra hard to break ties.\n\n*{}*\n{} people voted so far".format(message, num_votes)
+    return body
+
+
+def tie_break_count_votes(votes, candidates):
+    counts = [0] * len(candidates)
+    for vote in votes.values():
+        vote_counted = False
+        for preference in vote:
+            if preference in candidates and not vote_counted:
+                counts[candidates.index(preference)] += 1
+                vote_counted = True
+    return counts
+
+
+
+# Single transferable vote (stv_poll_handler)
+
+HOPEFUL, ELECTED, ELIMINATED = range(3)
+
+
+def stv_evaluation(poll):
+    votes = poll.get('votes', {})
+    numopts = int(poll.get('meta').get('numopts'))
+    candidates = [opt['index'] for opt in poll['options']]
+
+    quota = int(float(len(votes))/float(numopts + 1)) + 1
+
+    if votes:
+        candidate_info = {}
+        for candidate in candidates:
+            candidate_info[candidate] = {
+                'votes': {},
+                'status': HOPEFUL,
+            }
+        initialize_votes(candidate_info, votes)
+
+        elected, ties = stv_run_election(quota, numopts, votes, candidate_info)
+
+        elected_names = [get_option_name_by_index(poll, el) for el in elected]
+        tied_names = [get_option_name_by_index(poll, el) for el in ties]
+
+        message = "Current Top {}:\n".format(numopts)
+        for elected_name in elected_names:
+            message += "• *{}*\n".format(elected_name)
+
+        if ties:
+            message += "And in the end, we have a tie: \n"
+            message += "*{}*\n".format(", ".join(tied_names))
+
+    else:
+        message = "There are currently no votes."
+
+    num_votes = len(poll.get('votes', {}))
+
+    body = "This is a single transferable vote poll.\n" \
+           "You define an order of preference for the available options " \
+           "by clicking on them in that order. For evaluation, the lowest " \
+           "ranking candidate is eliminated until there are clear winners. \n" \
+           "Make sure to select all options that would work for you, but " \
+           "don't select any of those that don't work.\n\n{}\n{} people voted so far".format(message, num_votes)
+    return body
+
+
+def initialize_votes(candidate_info, votes):
+    for voter, vote in votes.items():
+        candidate_info[vote[0]]['votes'][voter] = 1.0
+
+
+def stv_run_election(quota, seats, votes, candidate_info):
+    if len(candidate_info) <= seats:
+        return list(candidate_info.keys()), []
+
+    elected_candidates = count_candidate_votes_and_check_for_elections(candidate_info, quota)
+    if not elected_candidates:
+        eliminated_candidates = eliminate_lowest_candidates(candidate_info)
+    transfer_votes(votes, quota, candidate_info)
+
+    (hopeful, elected, eliminated) = count_candidate_types(candidate_info)
+    hopeful_candidates = get_hopeful_candidates(candidate_info)
+
+    if hopeful + elected <= seats:
+        ties = []
+        if hopeful + elected < seats:
+            ties = eliminated_candidates
+        return elected_candidates + hopeful_candidates, ties
+    else:
+        el, ti = stv_run_election(quota, seats, votes, candidate_info)
+        return elected_candidates + el, ti
+
+
+def count_candidate_votes_and_check_for_elections(candidate_info, quota):
+    elected_candidates = []
+    for candidate, info in candidate_info.items():
+        candidate_votes = 0.0
+        for vote, value in info['votes'].items():
+            candidate_votes += value
+        if candidate_votes >= quota and info['status'] == HOPEFUL:
+            elected_candidates.append(candidate)
+            info['status'] = ELECTED
+        info['curr_vote_count'] = candidate_votes
+
+    return elected_candidates
+
+
+def transfer_votes(votes, quota, candidate_info):
+    for candidate, info in candidate_info.items():
+        if info['status'] == ELIMINATED:
+            retain_ratio = 0
+            transfer_ratio = 1
+        if info['status'] == ELECTED:
+            retain_ratio = quota / info['curr_vote_count']
+            transfer_ratio = 1 - retain_ratio
+        if info['status'] == HOPEFUL:
+            # retain all votes, no transfer
+            continue
+
+        del_voters = []
+        for voter, vote_value in info['votes'].items():
+            if retain_ratio == 0:
+                # schedule for deletion
+                del_voters.append(voter)
+            else:
+                info['votes'][voter] = vote_value * retain_ratio
+            transfer_value = vote_value * transfer_ratio
+            vote = votes[voter]
+            idx = vote.index(candidate)
+            while idx < len(vote) \
+                    and candidate_info[vote[idx]]['status'] != HOPEFUL:
+                idx += 1
+            if idx < len(vote):
+                candidate_info[vote[idx]]['votes'][voter] = transfer_value
+            else:
+                pass  # vote is lost
+        for del_voter in del_voters:
+            del info['votes'][del_voter]
+
+
+def eliminate_lowest_candidates(candidate_info):
+    minimum = float('inf')
+    lowest = []
+
+    for candidate, info in candidate_info.items():
+        if info['status'] == HOPEFUL:
+            if info['curr_vote_count'] < minimum:
+                lowest = [candidate]
+                minimum = info['curr_vote_count']
+            elif info['curr_vote_count'] == minimum:
+                lowest.append(candidate)
+
+    for candidate in lowest:
+        candidate_info[candidate]['status'] = ELIMINATED
+
+    return lowest
+
+
+def count_candidate_types(candidate_info):
+    hopeful, elected, eliminated = [0, 0, 0]
+
+    for candidate, info in candidate_info.items():
+        if info['status'] == HOPEFUL:
+            hopeful += 1
+        elif info['status'] == ELECTED:
+            elected += 1
+        elif info['status'] == ELIMINATED:
+            eliminated += 1
+
+    return hopeful, elected, eliminated
+
+
+def get_hopeful_candidates(candidate_info):
+    hopeful_candidates = []
+
+    for candidate, info in candidate_info.items():
+        if info['status'] == HOPEFUL:
+            hopeful_candidates.append(candidate)
+
+    return hopeful_candidates
+
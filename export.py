@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Exports the votes of poll instances as CSV or NDJSON.
+
+Instances are read from the database a batch at a time and their votes one
+at a time, and every line is written out as soon as it is produced, so
+databases of any size can be exported with little memory. Each poll type's
+handler turns its votes into rows through export_vote(): CSV has a row for
+every option a voter picked, NDJSON a line for every voter.
+
+    python export.py -c config.yml -f csv --since 2020-01-01 --until 2020-02-01 -o january.csv
+    python export.py -c config.yml -f ndjson -p 0b7c0a0e-3c3b-4a4e-8a1c-5d7d0f3c2b1a
+
+Votes still held in a write-behind journal are not exported until they have
+been written to the database.
+"""
+import calendar
+import csv
+import io
+import json
+import sys
+import time
+from optparse import OptionParser
+
+import yaml
+
+import storage
+import voter_directory
+
+FORMATS = ('csv', 'ndjson')
+
+INSTANCE_COLUMNS = ['instance_id', 'poll_id', 'chat_id', 'message_id', 'inline_message_id', 'created', 'type',
+                    'title']
+CSV_COLUMNS = INSTANCE_COLUMNS + ['user_id', 'name', 'option', 'option_text', 'rank', 'answer']
+
+
+def iter_ballots(storage, handlers, instances):
+    """Yield (instance fields, user, vote, export rows) for every vote on the instances."""
+    for row in instances:
+        handler = handlers[row['type']]
+        options = {option['index']: option['text'] for option in json.loads(row['options'])}
+        directory = json.loads(row['voters']) if row.get('voters') else None
+        names = voter_directory.names_by_id(directory)
+        instance = {
+            'instance_id': row['id'],
+            'poll_id': row['poll_id'],
+            'chat_id': row.get('chat_id'),
+            'message_id': row.get('message_id'),
+            'inline_message_id': row.get('inline_message_id'),
+            'created': row.get('created'),
+            'type': handler.name,
+            'title': row['title'],
+        }
+        for user, vote in storage.iter_votes(row):
+            rows = handler.export_vote(vote)
+            for export_row in rows:
+                if directory is not None or (isinstance(vote, dict) and 'name' in vote):
+                    export_row['name'] = voter_directory.voter_name(directory, names, user, vote)
+                if export_row.get('option') is not None:
+                    export_row['option_text'] = options.get(export_row['option'])
+            yield instance, user, vote, rows
+
+
+def csv_lines(ballots):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for instance, user, vote, rows in ballots:
+        for export_row in rows or [{}]:
+            writer.writerow(dict(instance, user_id=user, **export_row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_lines(ballots):
+    for instance, user, vote, rows in ballots:
+        yield json.dumps(dict(instance, user_id=user, vote=vote, choices=rows), ensure_ascii=False) + '\n'
+
+
+def export(storage, handlers, instances, outfile, format='csv'):
+    """Write the votes on the instances to a binary file, return the number of votes written."""
+    count = 0
+
+    def counted(ballots):
+        nonlocal count
+        for ballot in ballots:
+            count += 1
+            yield ballot
+
+    ballots = counted(iter_ballots(storage, handlers, instances))
+    lines = csv_lines(ballots) if format == 'csv' else ndjson_lines(ballots)
+    for line in lines:
+        outfile.write(line.encode('utf-8'))
+    return count
+
+
+def parse_date(text):
+    """Return the Unix timestamp of the start of a YYYY-MM-DD day in UTC."""
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d'))
+
+
+def main(opts):
+    # Imported here, PollBot imports this module.
+    from pollbot import POLL_HANDLERS
+
+    with open(opts.config, 'r') as configfile:
+        config = yaml.load(configfile, Loader=yaml.SafeLoader)
+    db = storage.connect(config)
+    instances = db.iter_instances(poll_id=opts.poll_id, instance_id=opts.instance_id,
+                                  since=parse_date(opts.since) if opts.since else None,
+                                  until=parse_date(opts.until) if opts.until else None)
+    if opts.output:
+        with open(opts.output, 'wb') as outfile:
+            count = export(db, POLL_HANDLERS, instances, outfile, opts.format)
+    else:
+        count = export(db, POLL_HANDLERS, instances, sys.stdout.buffer, opts.format)
+    print("Exported {} votes".format(count), file=sys.stderr)
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config", default="config.yml",
+                      help="Config file of the bot whose database is exported")
+    parser.add_option("-f", "--format", dest="format", type="choice", choices=FORMATS, default="csv",
+                      help="Output format, csv or ndjson")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="File to write to instead of standard output")
+    parser.add_option("-p", "--poll", dest="poll_id", default=None,
+                      help="Only export the instances of the poll with this id")
+    parser.add_option("-i", "--instance", dest="instance_id", type="int", default=None,
+                      help="Only export the instance with this row id")
+    parser.add_option("--since", dest="since", default=None,
+                      help="Only export instances created on or after this day (YYYY-MM-DD, UTC)")
+    parser.add_option("--until", dest="until", default=None,
+                      help="Only export instances created before this day (YYYY-MM-DD, UTC)")
+    opts, args = parser.parse_args()
+    main(opts)
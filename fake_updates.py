@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Runs the shard workers against a fake source of button presses.
+
+Generates Telegram callback query updates for many copies of a poll, routes
+them through a ShardRouter to worker processes using a temporary SQLite
+database and a fake Telegram bot, and checks the stored votes against the
+same button presses applied in a single process:
+
+    python fake_updates.py -s 4 -i 200 -m 50 -t 3
+"""
+import copy
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from optparse import OptionParser
+from types import SimpleNamespace
+
+import callback_data
+import database
+import storage
+from benchmark import BOT_ID, make_clicks, make_poll
+from pollbot import POLL_HANDLERS, PollBot
+from sharding import ShardRouter, instance_key, shard_for
+
+
+class FakeTelegramBot:
+    def get_me(self):
+        return SimpleNamespace(id=BOT_ID, username='fake_bot')
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+    def edit_message_text(self, **kwargs):
+        pass
+
+
+def make_updates(poll, num_instances, num_voters, seed):
+    """Return the callback query updates for num_instances inline copies of the poll, interleaved."""
+    rng = random.Random(seed)
+    per_instance = []
+    for instance in range(num_instances):
+        inline_message_id = 'fake-{}'.format(instance)
+        per_instance.append([(inline_message_id, user, name, callback_data.encode(item, poll['poll_id']))
+                             for user, name, item in make_clicks(poll, num_voters, rng)])
+
+    updates = []
+    while any(per_instance):
+        clicks = rng.choice([clicks for clicks in per_instance if clicks])
+        inline_message_id, user, name, data = clicks.pop(0)
+        updates.append({
+            'update_id': len(updates) + 1,
+            'callback_query': {
+                'id': str(len(updates) + 1),
+                'from': {'id': int(user), 'is_bot': False, 'first_name': name},
+                'chat_instance': inline_message_id,
+                'inline_message_id': inline_message_id,
+                'data': data,
+            },
+        })
+    return updates
+
+
+def expected_votes(poll, updates):
+    """Apply the button presses in order in this process, return the votes per inline message id."""
+    handler = POLL_HANDLERS[poll['type']]
+    votes = {}
+    for update in updates:
+        query = update['callback_query']
+        instance_votes = votes.setdefault(query['inline_message_id'], {})
+        handler.handle_vote(instance_votes, str(query['from']['id']), query['from']['first_name'],
+                            callback_data.decode(query['data']))
+    return votes
+
+
+def main(opts):
+    workdir = tempfile.mkdtemp(prefix='pollbot-shards-')
+    try:
+        config = {
+            'token': '123:fake',
+            'db': os.path.join(workdir, 'votes.db'),
+            'edit_interval': 0,
+            'workers': opts.workers,
+        }
+        if opts.write_behind:
+            config['write_behind'] = {'journal': os.path.join(workdir, 'votes.db.journal')}
+
+        front = PollBot()
+        front.storage = storage.SqliteStorage(database.connect_sqlite(config['db']))
+        front.storage.migrate()
+        poll = make_poll(opts.polltype, opts.options)
+        template = dict(poll)
+        template.pop('votes')
+        front.storage.create_template(front.serialize(template))
+
+        updates = make_updates(poll, opts.instances, opts.voters, opts.seed)
+        shards = Counter(shard_for(instance_key(update), opts.shards) for update in updates)
+        print("{} button presses on {} instances, per shard: {}".format(
+            len(updates), opts.instances, dict(sorted(shards.items()))))
+
+        router = ShardRouter(config, opts.shards, bot_factory=FakeTelegramBot)
+        router.start()
+        start = time.perf_counter()
+        for update in updates:
+            router.route(copy.deepcopy(update))
+        router.stop()
+        elapsed = time.perf_counter() - start
+        print("Handled in {:.2f}s, {:.0f} button presses/s".format(elapsed, len(updates) / elapsed))
+
+        voters = {}
+        for update in updates:
+            query = update['callback_query']
+            voters.setdefault(query['inline_message_id'], set()).add(str(query['from']['id']))
+
+        mismatches = 0
+        for inline_message_id, votes in expected_votes(poll, updates).items():
+            stored = front.load_instance({'inline_message_id': inline_message_id}, poll['poll_id'])['votes']
+            if opts.workers == 1:
+                # Each shard handled its presses in order, so the outcome must be exactly the same.
+                same = stored == votes
+            else:
+                # Presses on one instance may have been reordered, so only check nobody else got a vote.
+                same = set(stored) <= voters[inline_message_id]
+            if not same:
+                mismatches += 1
+                print("Mismatch on {}: expected {}, stored {}".format(inline_message_id, votes, stored))
+        print("{} of {} instances differ from a single process".format(mismatches, opts.instances))
+        front.storage.close()
+        return 1 if mismatches else 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-s", "--shards", dest="shards", type="int", default=4,
+                      help="Number of shard worker processes")
+    parser.add_option("-i", "--instances", dest="instances", type="int", default=100,
+                      help="Number of poll instances voted on")
+    parser.add_option("-m", "--voters", dest="voters", type="int", default=20,
+                      help="Number of voters per instance")
+    parser.add_option("-n", "--options", dest="options", type="int", default=5,
+                      help="Number of poll options")
+    parser.add_option("-t", "--type", dest="polltype", type="int", default=0,
+                      help="Poll type, one of: {}".format(", ".join("{} ({})".format(k, v.__name__)
+                                                                    for k, v in POLL_HANDLERS.items())))
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                      help="Threads per shard. With more than one, only the voters are compared")
+    parser.add_option("--write-behind", dest="write_behind", action="store_true", default=False,
+                      help="Journal votes and write them behind in every shard")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+                      help="Seed for the random button presses")
+    opts, args = parser.parse_args()
+    sys.exit(main(opts))
@@ -68,45 +68,67 @@ def evaluation(poll):
 
 def run_election(candidates, votes, skip_index=0):
 
-    if not any([v[skip_index:] for v in votes]):
+    if not any(len(v) > skip_index for v in votes):
         # No votes left - it's a tie.
         return candidates
 
-    elected = None
-    quota = math.floor(len(votes) / 2) + 1
+    elected, tied = count_rounds(candidates, votes)
+    if elected is None:
+        # The last remaining candidates were eliminated at the same time. We have a tie!
+        return tied
+    return elected
+
 
-    while elected is None:
-        counts = count_votes(votes, candidates, skip_index)
+def count_rounds(candidates, votes):
+    """Eliminate the lowest ranking candidates until somebody reaches the quota.
+
+    Returns (elected, None) once a candidate reaches the quota, or (None, tied) if
+    all remaining candidates would have to be eliminated at the same time.
+
+    Every ballot points at its top preference among the remaining candidates, and
+    only the ballots on an eliminated candidate are moved on, so a round costs
+    O(candidates + transferred ballots) instead of a recount of all ballots.
+    """
+    quota = math.floor(len(votes) / 2) + 1
+    remaining = list(candidates)
+    active = set(remaining)
+    piles = {candidate: [] for candidate in remaining}
+    positions = [0] * len(votes)
+
+    def place(ballot):
+        vote = votes[ballot]
+        pos = positions[ballot]
+        while pos < len(vote) and vote[pos] not in active:
+            pos += 1
+        positions[ballot] = pos
+        if pos < len(vote):
+            piles[vote[pos]].append(ballot)
+
+    for ballot in range(len(votes)):
+        place(ballot)
+
+    while True:
+        counts = [len(piles[candidate]) for candidate in remaining]
         max_votes = max(counts)
         if max_votes >= quota:
             # Somebody has hit the quota, elect them:
-            elected = [candidates[i] for i, count in enumerate(counts) if count == max_votes]
-        else:
-            min_votes = min(counts)
-            old_candidates = list(candidates)
-            # eliminate all candidates with lowest count:
-            delete_pls = []
-            for i, count in enumerate(counts):
-                if count == min_votes:
-                    delete_pls.append(candidates[i])
-            for candidate in delete_pls:
-                candidates.remove(candidate)
-            if not candidates:
-                # The last remaining candidates were eliminated at the same time. We have a tie!
-                # Battle these remaining candidates:
-                return run_election(old_candidates, votes, skip_index=skip_index + 1)
-    return elected
+            return [candidate for candidate, count in zip(remaining, counts) if count == max_votes], None
 
+        min_votes = min(counts)
+        # eliminate all candidates with lowest count:
+        eliminated = [candidate for candidate, count in zip(remaining, counts) if count == min_votes]
+        if len(eliminated) == len(remaining):
+            return None, remaining
+
+        active.difference_update(eliminated)
+        remaining = [candidate for candidate in remaining if candidate in active]
+        for candidate in eliminated:
+            for ballot in piles.pop(candidate):
+                place(ballot)
 
-def count_votes(votes, candidates, skip_index):
-    counts = [0] * len(candidates)
-    for vote in votes:
-        vote_counted = False
-        for preference in vote:
-            if preference in candidates and not vote_counted:
-                counts[candidates.index(preference)] += 1
-                vote_counted = True
-    return counts
+
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C',))
 
 
 def handle_vote(votes, user, name, callback_data):
@@ -128,6 +150,10 @@ def handle_vote(votes, user, name, callback_data):
         votes[user] = old_vote
 
 
+def export_vote(vote):
+    return [{'option': index, 'rank': rank} for rank, index in enumerate(vote, start=1)]
+
+
 def get_confirmation_message(poll, user):
     votes = poll['votes']
     if user in votes:
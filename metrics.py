@@ -0,0 +1,222 @@
+"""Latency histograms, counters and gauges, served in the Prometheus text format.
+
+Requests (button presses, inline queries, finished polls) are timed as a
+whole and split into phases: reading from the database, the poll handler's
+computation, writing to the database, rendering the message and calling the
+Telegram API. Phases are attributed to the request running on the current
+thread, and both are labelled with the poll type once it is known.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels, extra=()):
+    items = sorted(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in items) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for labels, (counts, total, num) in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels, [('le', bound)]), count))
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels, [('le', '+Inf')]), num))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), num))
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = Counter()
+
+    def inc(self, amount, labels):
+        self.series[labels] += amount
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for labels, value in sorted(self.series.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(labels), value))
+        return lines
+
+
+class Gauge:
+    """A value that goes up and down, read from read() whenever the metrics are exposed."""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def expose(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, self.read())]
+
+
+class RequestTimer:
+    """Collects the phase timings of one request until its poll type is known."""
+
+    def __init__(self, registry, request):
+        self.registry = registry
+        self.request = request
+        self.poll_type = 'unknown'
+        self.start = time.perf_counter()
+        self.phases = []
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+        self.local = threading.local()
+        self.histogram('pollbot_request_seconds', "Time spent handling a request")
+        self.histogram('pollbot_phase_seconds', "Time spent in each phase of handling a request")
+        self.counter('pollbot_requests_total', "Requests handled")
+        self.counter('pollbot_errors_total', "Requests that failed")
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        self.metrics[name] = Histogram(name, help, buckets)
+
+    def counter(self, name, help):
+        self.metrics[name] = CounterMetric(name, help)
+
+    def gauge(self, name, help, read):
+        self.metrics[name] = Gauge(name, help, read)
+
+    def collect(self, name, help, counters, label):
+        """Expose a collections.Counter kept elsewhere as a counter, with its keys as label values."""
+        self.collectors.append((name, help, counters, label))
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name].observe(value, tuple(sorted(labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            self.metrics[name].inc(amount, tuple(sorted(labels.items())))
+
+    @contextmanager
+    def request(self, request):
+        """Time a request handled on this thread. Yields the timer, set its poll_type once known."""
+        timer = RequestTimer(self, request)
+        outer = getattr(self.local, 'timer', None)
+        self.local.timer = timer
+        failed = False
+        try:
+            yield timer
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.local.timer = outer
+            elapsed = time.perf_counter() - timer.start
+            with self.lock:
+                labels = (('poll_type', timer.poll_type), ('request', request))
+                self.metrics['pollbot_request_seconds'].observe(elapsed, labels)
+                self.metrics['pollbot_requests_total'].inc(1, labels)
+                if failed:
+                    self.metrics['pollbot_errors_total'].inc(1, labels)
+                for phase, seconds in timer.phases:
+                    self.metrics['pollbot_phase_seconds'].observe(seconds, (('phase', phase),) + labels)
+
+    @contextmanager
+    def phase(self, phase, request=None, poll_type=None):
+        """Time a phase of the request running on this thread.
+
+        Outside of a request, for example for message edits sent later, the phase is
+        recorded on its own under the given request name and poll type.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            timer = getattr(self.local, 'timer', None)
+            if timer is not None:
+                timer.phases.append((phase, elapsed))
+            else:
+                self.observe('pollbot_phase_seconds', elapsed, phase=phase,
+                             request=request or 'background', poll_type=poll_type or 'unknown')
+
+    def set_poll_type(self, poll_type):
+        timer = getattr(self.local, 'timer', None)
+        if timer is not None:
+            timer.poll_type = poll_type
+
+    def expose(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.extend(metric.expose())
+            for name, help, counters, label in self.collectors:
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(dict(counters).items()):
+                    lines.append('{}{} {}'.format(name, format_labels([(label, key)]), value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, registry, listen='127.0.0.1', port=9090):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/', '/metrics'):
+                    handler.send_error(404)
+                    return
+                body = registry.expose().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', CONTENT_TYPE)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((listen, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        logger.info("Serving metrics on %s:%s", *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,167 @@
+"""Versioned schema migrations for the poll database.
+
+Each entry in MIGRATIONS upgrades the schema by one version. The version the
+database is at is recorded in the ``schema_info`` table, and ``migrate`` applies
+all migrations the database hasn't seen yet, in order.
+"""
+import logging
+
+import poll_search
+import vote_storage
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_INFO_TABLE = 'schema_info'
+
+# What PostgreSQL searches poll templates in: the title and the texts of the options.
+POSTGRES_SEARCH_DOCUMENT = ("to_tsvector('simple', coalesce(title, '') || ' ' || "
+                            "coalesce(jsonb_path_query_array(options::jsonb, '$[*].text')::text, ''))")
+
+
+def get_schema_version(db):
+    row = db[SCHEMA_INFO_TABLE].find_one(key='version')
+    return 0 if row is None else int(row['value'])
+
+
+def set_schema_version(db, version):
+    db[SCHEMA_INFO_TABLE].upsert({'key': 'version', 'value': version}, ['key'])
+
+
+def ensure_columns(table, columns):
+    for column, column_type in columns:
+        if not table.has_column(column):
+            table.create_column(column, column_type)
+
+
+def remove_duplicates(db, table, columns):
+    # Concurrent first clicks could insert the same instance more than once.
+    # Lookups always found the first row inserted, so that's the one with the
+    # votes; the others were never read again.
+    where = ' AND '.join('{} IS NOT NULL'.format(c) for c in columns)
+    group = ', '.join(columns)
+    duplicates = ('FROM {table} WHERE {where} AND id NOT IN '
+                  '(SELECT MIN(id) FROM {table} WHERE {where} GROUP BY {group})'
+                  .format(table=table, where=where, group=group))
+    count = next(iter(db.query('SELECT COUNT(*) AS count ' + duplicates)))['count']
+    if count:
+        logger.warning("Removing %s duplicate rows of %s by %s", count, table, group)
+        db.query('DELETE ' + duplicates)
+    return count
+
+
+def create_lookup_indexes(db):
+    instances = db['setpoll_instances']
+    templates = db['setpolls']
+    ensure_columns(instances, [
+        ('chat_id', db.types.bigint),
+        ('message_id', db.types.bigint),
+        ('inline_message_id', db.types.string),
+    ])
+    ensure_columns(templates, [
+        ('poll_id', db.types.string),
+    ])
+
+    remove_duplicates(db, 'setpoll_instances', ['chat_id', 'message_id'])
+    remove_duplicates(db, 'setpoll_instances', ['inline_message_id'])
+    remove_duplicates(db, 'setpolls', ['poll_id'])
+
+    instances.create_index(['chat_id', 'message_id'], name='ix_instances_chat_message', unique=True)
+    instances.create_index(['inline_message_id'], name='ix_instances_inline_message', unique=True)
+    templates.create_index(['poll_id'], name='ix_setpolls_poll_id', unique=True)
+
+
+def create_search_index(db):
+    # Polls created before this had no creator recorded, so their user_id stays
+    # NULL: they are left out of searches but can still be shared by their poll id.
+    ensure_columns(db['setpolls'], [
+        ('user_id', db.types.bigint),
+    ])
+    db['setpolls'].create_index(['user_id'], name='ix_setpolls_user_id')
+    if db.engine.dialect.name == 'sqlite' and poll_search.create_index(db):
+        poll_search.rebuild_index(db)
+
+
+def add_instance_versions(db):
+    # Instances are created concurrently from now on, so they can't rely on
+    # the first insert creating their columns.
+    ensure_columns(db['setpoll_instances'], [
+        ('poll_id', db.types.string),
+        ('title', db.types.text),
+        ('type', db.types.integer),
+        ('options', db.types.text),
+        ('meta', db.types.text),
+        ('user_id', db.types.bigint),
+        ('votes', db.types.text),
+        ('tally', db.types.text),
+        ('version', db.types.bigint),
+    ])
+    db.query('UPDATE setpoll_instances SET version = 0 WHERE version IS NULL')
+
+
+def create_votes_table(db):
+    votes = db[vote_storage.VOTES_TABLE]
+    ensure_columns(votes, [
+        ('instance_id', db.types.bigint),
+        ('user_id', db.types.string),
+        ('payload', db.types.text),
+    ])
+    votes.create_index(['instance_id', 'user_id'], name='ix_votes_instance_user', unique=True)
+
+
+def create_postgres_search_index(db):
+    # SQLite databases are searched through the FTS index from create_search_index.
+    if db.engine.dialect.name != 'postgresql':
+        return
+    # On a new database the template columns only exist once the first poll is created.
+    ensure_columns(db['setpolls'], [
+        ('title', db.types.text),
+        ('type', db.types.integer),
+        ('options', db.types.text),
+        ('meta', db.types.text),
+    ])
+    db.query('CREATE INDEX IF NOT EXISTS ix_setpolls_search ON setpolls USING gin ({})'
+             .format(POSTGRES_SEARCH_DOCUMENT))
+
+
+def add_creation_times(db):
+    # Unix timestamps, so exports can select a date range. Older polls don't have one.
+    for table in ('setpolls', 'setpoll_instances'):
+        ensure_columns(db[table], [
+            ('created', db.types.bigint),
+        ])
+    db['setpoll_instances'].create_index(['created'], name='ix_instances_created')
+
+
+def add_voter_directories(db):
+    # The names of the voters on open polls, see voter_directory.py.
+    ensure_columns(db['setpoll_instances'], [
+        ('voters', db.types.text),
+    ])
+
+
+MIGRATIONS = [
+    create_lookup_indexes,
+    create_search_index,
+    add_instance_versions,
+    create_votes_table,
+    create_postgres_search_index,
+    add_creation_times,
+    add_voter_directories,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(db):
+    version = get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database schema version {} is newer than this bot supports ({})"
+                           .format(version, SCHEMA_VERSION))
+
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Migrating database schema to version %s (%s)", target, migration.__name__)
+        with db as tx:
+            migration(tx)
+            set_schema_version(tx, target)
+
+    return get_schema_version(db)
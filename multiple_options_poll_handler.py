@@ -1,5 +1,6 @@
 from functools import reduce
 from base_poll_handler import *
+import vote_tally
 
 name = "Multiple options poll"
 desc = "Lets you vote for multiple options"
@@ -30,6 +31,10 @@ def evaluation(poll):
     return message
 
 
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C',))
+
+
 def handle_vote(votes, user, name, callback_data):
     old_vote = None
     if user in votes:
@@ -59,7 +64,18 @@ def get_confirmation_message(poll, user):
     return "Your vote was removed."
 
 
+def selected_options(vote):
+    return [] if vote is None else list(vote)
+
+
+def export_vote(vote):
+    return [{'option': index} for index in vote]
+
+
 def num_votes_on_option(poll, index):
+    tallied = vote_tally.count(poll, index)
+    if tallied is not None:
+        return tallied
     if 'votes' not in poll:
         return 0
     votes = poll['votes']
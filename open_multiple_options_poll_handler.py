@@ -1,5 +1,9 @@
 from functools import reduce
 from base_poll_handler import *
+from open_poll_handler import list_voters
+import vote_tally
+import voter_directory
+from voter_directory import vote_data
 
 name = "Open multiple options poll"
 desc = "Lets you vote for multiple options, and people can see who voted for what."
@@ -24,41 +28,40 @@ def options(poll):
 
 def evaluation(poll):
     message = "This is an open multiple choices poll. People will see what you voted for.\n"
-    for i, option in enumerate(poll['options']):
-        message += "\n"
-        message += "*{}: {}*".format(option['text'], num_votes_on_option(poll, i))
-        users = get_users_voting_for(poll, option)
-        for user in users:
-            message += "\n "
-            message += user
-    return message
+    return message + list_voters(poll, num_votes_on_option, selected_options)
+
+
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C',))
 
 
 def handle_vote(votes, user, name, callback_data):
     old_vote = None
     if user in votes:
-        old_vote = votes.pop(user)
+        # The voter's name goes to the voter directory, see update_voter().
+        old_vote = list(vote_data(votes.pop(user)))
     if callback_data['i'] == 'C':
         # remove vote
         pass
-    elif old_vote is not None and callback_data['i'] in old_vote['data']:
-        old_vote['data'].remove(callback_data['i'])
-        if old_vote['data']:
+    elif old_vote is not None and callback_data['i'] in old_vote:
+        old_vote.remove(callback_data['i'])
+        if old_vote:
             votes[user] = old_vote
     elif old_vote is not None:
-        old_vote['data'].append(callback_data['i'])
+        old_vote.append(callback_data['i'])
         votes[user] = old_vote
     else:
-        votes[user] = {
-            'name': name,
-            'data':[callback_data['i']]
-        }
+        votes[user] = [callback_data['i']]
+
+
+def update_voter(poll, user, name):
+    voter_directory.update(poll, user, name)
 
 
 def get_confirmation_message(poll, user):
     votes = poll['votes']
     if user in votes:
-        vote = votes[user]
+        vote = vote_data(votes[user])
         opts = poll['options']
         vote_set = [opt['text'] for opt in opts if opt['index'] in vote]
         string = ",".join(vote_set) if vote_set else "nothing"
@@ -67,17 +70,28 @@ def get_confirmation_message(poll, user):
 
 
 def get_users_voting_for(poll, option):
-    return [val['name'] for val in poll['votes'].values() if option['index'] in val['data']] if 'votes' in poll else []
+    return voter_directory.names_by_option(poll, selected_options)[0].get(option['index'], [])
+
+
+def selected_options(vote):
+    return [] if vote is None else list(vote_data(vote))
+
+
+def export_vote(vote):
+    return [{'option': index} for index in vote_data(vote)]
 
 
 def num_votes_on_option(poll, index):
+    tallied = vote_tally.count(poll, index)
+    if tallied is not None:
+        return tallied
     if 'votes' not in poll:
         return 0
     votes = poll['votes']
 
     num = 0
     for cast_vote in votes.values():
-        if index in cast_vote['data']:
+        if index in vote_data(cast_vote):
             num += 1
     return num
 
@@ -1,4 +1,6 @@
 from basic_poll_handler import *
+import voter_directory
+from voter_directory import vote_data
 
 name = "Open poll"
 desc = "Like basic poll, but you can see who voted for what."
@@ -6,13 +8,22 @@ desc = "Like basic poll, but you can see who voted for what."
 
 def evaluation(poll):
     message = "This is an open poll. People will see what you voted for.\n"
+    return message + list_voters(poll, num_votes)
+
+
+def list_voters(poll, count, select=None):
+    # Long lists are cut short, so the message stays within Telegram's length limit.
+    max_length = voter_directory.MAX_NAMES_LENGTH // max(len(poll['options']), 1)
+    names, hidden = voter_directory.names_by_option(poll, select or selected_options, max_length)
+    message = ""
     for i, option in enumerate(poll['options']):
         message += "\n"
-        message += "*{}: {}*".format(option['text'], num_votes(poll, i))
-        users = get_users_voting_for(poll, option)
-        for user in users:
+        message += "*{}: {}*".format(option['text'], count(poll, i))
+        for name in names.get(option['index'], []):
             message += "\n "
-            message += user
+            message += name
+        if hidden[option['index']]:
+            message += "\n _and {} more_".format(hidden[option['index']])
     return message
 
 
@@ -20,14 +31,16 @@ def handle_vote(votes, user, name, callback_data):
     old_vote = None
     if user in votes:
         old_vote = votes.pop(user)
-    if old_vote is not None and str(old_vote['data']) == str(callback_data['i']):
+    if old_vote is not None and str(vote_data(old_vote)) == str(callback_data['i']):
         # remove old vote
         pass
     else:
-        votes[user] = {
-            'data': callback_data['i'],
-            'name': name
-        }
+        # The voter's name goes to the voter directory, see update_voter().
+        votes[user] = callback_data['i']
+
+
+def update_voter(poll, user, name):
+    voter_directory.update(poll, user, name)
 
 
 def get_confirmation_message(poll, user):
@@ -35,14 +48,25 @@ def get_confirmation_message(poll, user):
     if user in votes:
         vote = votes[user]
         for option in poll['options']:
-            if option['index'] == vote['data']:
+            if option['index'] == vote_data(vote):
                 return "You voted for \"{}\".".format(option['text'])
     return "Your vote was removed."
 
 
+def selected_options(vote):
+    return [] if vote is None else [vote_data(vote)]
+
+
+def export_vote(vote):
+    return [{'option': vote_data(vote)}]
+
+
 def num_votes(poll, i):
-    return [val['data'] for val in poll['votes'].values()].count(i) if 'votes' in poll else 0
+    tallied = vote_tally.count(poll, i)
+    if tallied is not None:
+        return tallied
+    return [vote_data(val) for val in poll['votes'].values()].count(i) if 'votes' in poll else 0
 
 
 def get_users_voting_for(poll, option):
-    return [val['name'] for val in poll['votes'].values() if val['data'] == option['index']] if 'votes' in poll else []
+    return voter_directory.names_by_option(poll, selected_options)[0].get(option['index'], [])
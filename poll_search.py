@@ -0,0 +1,85 @@
+"""Full-text search over poll titles and options for inline queries.
+
+Polls are indexed in an SQLite FTS5 table that shares its rowids with
+``setpolls``. If the SQLite build lacks FTS5, searches fall back to a bounded
+LIKE query.
+"""
+import json
+import logging
+import re
+
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'setpolls_fts'
+
+# Telegram accepts at most 50 results per inline query answer.
+PAGE_SIZE = 50
+
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def has_fts(db):
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    result = db.query("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name", name=FTS_TABLE)
+    return any(True for _ in result)
+
+
+def create_index(db):
+    try:
+        db.query("CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+                 "title, options, user_id, tokenize = 'unicode61 remove_diacritics 2')".format(FTS_TABLE))
+    except OperationalError as e:
+        logger.warning('Could not create full-text index, falling back to LIKE searches: "%s"', e)
+        return False
+    return True
+
+
+def rebuild_index(db):
+    db.query("DELETE FROM {}".format(FTS_TABLE))
+    for row in db['setpolls'].all():
+        index_poll(db, row['id'], row)
+
+
+def index_poll(db, row_id, poll):
+    if not has_fts(db):
+        return
+    options = poll['options']
+    if isinstance(options, str):
+        options = json.loads(options)
+    db.query("INSERT INTO {} (rowid, title, options, user_id) VALUES (:rowid, :title, :options, :user_id)"
+             .format(FTS_TABLE),
+             rowid=row_id,
+             title=poll['title'] or '',
+             options='\n'.join(opt['text'] for opt in options),
+             user_id='' if poll.get('user_id') is None else str(poll['user_id']))
+
+
+def search(db, user_id, query, offset=0, limit=PAGE_SIZE):
+    """Return one page of the user's polls matching the query, best matches first."""
+    limit = min(limit, PAGE_SIZE)
+    terms = TERM_PATTERN.findall(query)
+
+    if not terms:
+        return list(db.query("SELECT * FROM setpolls WHERE user_id = :user_id "
+                             "ORDER BY id DESC LIMIT :limit OFFSET :offset",
+                             user_id=user_id, limit=limit, offset=offset))
+
+    if has_fts(db):
+        match = 'user_id : "{}" AND {{title options}} : ({})'.format(
+            user_id, ' '.join('"{}"*'.format(term) for term in terms))
+        return list(db.query("SELECT setpolls.* FROM {fts} JOIN setpolls ON setpolls.id = {fts}.rowid "
+                             "WHERE {fts} MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"
+                             .format(fts=FTS_TABLE),
+                             match=match, limit=limit, offset=offset))
+
+    return list(db.query("SELECT * FROM setpolls WHERE user_id = :user_id AND title LIKE :pattern ESCAPE '\\' "
+                         "ORDER BY id DESC LIMIT :limit OFFSET :offset",
+                         user_id=user_id, pattern='%{}%'.format(escape_like(query)), limit=limit, offset=offset))
+
+
+def escape_like(text):
+    # So % and _ in the query match themselves.
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
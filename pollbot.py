@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import copy
 import random
+import tempfile
+import threading
+import time
+from collections import Counter
 from uuid import uuid4
 
 import yaml
@@ -8,8 +13,6 @@ from telegram import InlineKeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRem
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler
 import logging
 
-import dataset
-
 import json
 
 from telegram.ext.inlinequeryhandler import InlineQueryHandler
@@ -29,6 +32,21 @@ import custom_description_instant_runoff_poll_handler
 import multiple_options_poll_handler
 import open_multiple_options_poll_handler
 import doodle_poll_handler
+import async_bot
+import callback_data
+import export
+import metrics
+import poll_search
+import rate_limit
+import sharding
+import storage
+import vote_storage
+import vote_tally
+import webhook
+from render_cache import RenderCache, render_key
+from render_scheduler import RenderScheduler
+from striped_lock import StripedLock
+from write_behind import WriteBehind
 
 
 POLL_TYPE_BASIC, \
@@ -66,6 +84,10 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 
+# How often a vote is retried when the poll instance is changed concurrently
+MAX_VOTE_ATTEMPTS = 10
+VOTE_RETRY_BACKOFF = 0.01
+
 # Conversation states:
 NOT_ENGAGED, TYPING_TITLE, TYPING_TYPE, TYPING_OPTION, TYPING_META = range(5)
 
@@ -82,9 +104,40 @@ AFFIRMATIONS = [
 ]
 
 
+def keyboard_size(reply_markup):
+    # Roughly what the keyboard takes up, counting the text and callback data of every button.
+    size = 0
+    for row in reply_markup.inline_keyboard:
+        for button in row:
+            size += 100 + len(button.text) + len(button.callback_data or '')
+    return size
+
+
 class PollBot:
     def __init__(self):
-        self.db = None
+        self.storage = None
+        self.bot_user = None
+        self.counters = Counter()
+        self.render_scheduler = RenderScheduler()
+        self.render_cache = RenderCache()
+        self.metrics = metrics.Registry()
+        self.metrics.collect('pollbot_edits_total', "Message edits by outcome, rate_limited counts 429s",
+                             self.render_scheduler.counters, 'outcome')
+        self.metrics.collect('pollbot_render_cache_total', "Render cache lookups and evictions",
+                             self.render_cache.counters, 'event')
+        self.metrics.collect('pollbot_events_total', "Other events counted by the bot", self.counters, 'event')
+        self.metrics.counter('pollbot_dispatcher_errors_total', "Errors raised by update handlers")
+        self.metrics.gauge('pollbot_pending_edits', "Poll messages waiting for an edit",
+                           self.render_scheduler.queue_depth)
+        self.instance_locks = StripedLock()
+        self.vote_storage = vote_storage.JsonVoteStorage()
+        self.write_behind = None
+        self.click_limiter = None
+        self.stv_exact_counting = False
+
+    @property
+    def db(self):
+        return self.storage.db
 
     # Conversation handlers:
     def start(self, update, context):
@@ -99,6 +152,9 @@ class PollBot:
         context.user_data['type'] = polltype
         context.user_data['options'] = []
         context.user_data['meta'] = dict()
+        if polltype == POLL_TYPE_STV and self.stv_exact_counting:
+            # Stored with the poll, so its result doesn't change if the setting does.
+            context.user_data['meta']['exact_counting'] = True
 
         if POLL_HANDLERS[polltype].requires_extra_config(context.user_data['meta']):
             update.message.reply_text(POLL_HANDLERS[polltype].ask_for_extra_config(context.user_data.get('meta')))
@@ -146,34 +202,54 @@ class PollBot:
             return TYPING_OPTION
 
     def handle_done(self, update, context):
-        update.message.reply_text("Thanks man! Now here is your fine poll:")
-        options = []
-        for i,opt in enumerate(context.user_data['options']):
-            options.append({
-                'text': opt,
-                'index': i
-            })
-
-        poll = {
-            'poll_id': str(uuid4()),
-            'title': context.user_data['title'],
-            'type': context.user_data['type'],
-            'options': options,
-            'meta': context.user_data.get('meta'),
-        }
-
-        table = self.db['setpolls']
-
-        table.insert(self.serialize(poll))
-
-        update.message.reply_text(self.assemble_message_text(poll),
-                                  reply_markup=self.assemble_inline_keyboard(poll, True),
-                                  parse_mode='Markdown'
-                                  )
-
-        context.user_data.clear()
-
-        return NOT_ENGAGED
+        with self.metrics.request('handle_done') as timer:
+            with self.metrics.phase('telegram'):
+                update.message.reply_text("Thanks man! Now here is your fine poll:")
+            options = []
+            for i,opt in enumerate(context.user_data['options']):
+                options.append({
+                    'text': opt,
+                    'index': i
+                })
+
+            poll = {
+                'poll_id': str(uuid4()),
+                'title': context.user_data['title'],
+                'type': context.user_data['type'],
+                'options': options,
+                'meta': context.user_data.get('meta'),
+                'user_id': update.message.from_user.id,
+                'created': int(time.time()),
+            }
+
+            timer.poll_type = self.get_handler(poll).__name__
+            with self.metrics.phase('db_write'):
+                self.storage.create_template(self.serialize(poll))
+
+            with self.metrics.phase('render'):
+                text = self.assemble_message_text(poll)
+                reply_markup = self.assemble_inline_keyboard(poll, True)
+            with self.metrics.phase('telegram'):
+                update.message.reply_text(text,
+                                          reply_markup=reply_markup,
+                                          parse_mode='Markdown'
+                                          )
+
+            context.user_data.clear()
+
+            return NOT_ENGAGED
+
+    def refresh_bot_identity(self, bot):
+        """Fetch the bot's own user from Telegram. Call this again if the bot account changes."""
+        self.bot_user = bot.get_me()
+        logger.info("Running as @%s (%s)", self.bot_user.username, self.bot_user.id)
+        return self.bot_user
+
+    def get_bot_id(self, bot):
+        if self.bot_user is None:
+            return self.refresh_bot_identity(bot).id
+        self.counters['get_me_calls_saved'] += 1
+        return self.bot_user.id
 
     def get_affirmation(self):
         return random.choice(AFFIRMATIONS)
@@ -194,11 +270,21 @@ class PollBot:
         return regex
 
     def assemble_inline_keyboard(self, poll, include_publish_button=False):
+        key = render_key(poll)
+        if key is not None:
+            key += ('keyboard', include_publish_button)
+        return self.render_cache.get(key,
+                                     lambda: self.build_inline_keyboard(poll, include_publish_button),
+                                     keyboard_size)
+
+    def build_inline_keyboard(self, poll, include_publish_button=False):
         inline_keyboard_items = self.get_inline_keyboard_items(poll)
         if include_publish_button:
             publish_button = InlineKeyboardButton("Publish!",
                                                   switch_inline_query=poll['poll_id'])
-            inline_keyboard_items.append([publish_button])
+            export_button = InlineKeyboardButton("Export votes",
+                                                 callback_data=callback_data.encode({'a': 'x'}, poll['poll_id']))
+            inline_keyboard_items.append([publish_button, export_button])
 
         return InlineKeyboardMarkup(inline_keyboard_items)
 
@@ -209,13 +295,19 @@ class PollBot:
         for row in button_items:
             current_row = []
             for item in row:
-                item['callback_data']['id'] = poll['poll_id']
                 current_row.append(InlineKeyboardButton(item['text'],
-                                                        callback_data=json.dumps(item['callback_data'], separators=(',', ':')) ))
+                                                        callback_data=callback_data.encode(item['callback_data'],
+                                                                                           poll['poll_id'])))
             buttons.append(current_row)
         return buttons
 
     def assemble_message_text(self, poll):
+        key = render_key(poll)
+        if key is not None:
+            key += ('text',)
+        return self.render_cache.get(key, lambda: self.build_message_text(poll), len)
+
+    def build_message_text(self, poll):
         handler = POLL_HANDLERS[poll['type']]
         message = '{}\n{}'.format(handler.title(poll),
                                   handler.evaluation(poll))
@@ -225,9 +317,13 @@ class PollBot:
         ser = dict(poll)
         ser['options'] = json.dumps(poll['options'])
         if 'votes' in ser:
-            ser['votes'] = json.dumps(poll['votes'])
+            ser['votes'] = self.vote_storage.dump(poll['votes'])
         if 'meta' in ser:
             ser['meta'] = json.dumps(poll['meta'])
+        if 'tally' in ser:
+            ser['tally'] = json.dumps(poll['tally'])
+        if 'voters' in ser:
+            ser['voters'] = json.dumps(poll['voters'])
         return ser
 
     def deserialize(self, serialized):
@@ -238,94 +334,290 @@ class PollBot:
         if 'meta' in poll:
             meta = serialized['meta']
             poll['meta'] = "" if meta is None else json.loads(meta)
+        if 'tally' in poll:
+            tally = serialized['tally']
+            poll['tally'] = None if tally is None else json.loads(tally)
+        if 'voters' in poll:
+            voters = serialized['voters']
+            poll['voters'] = None if voters is None else json.loads(voters)
         return poll
 
     # Inline query handler
     def inline_query(self, update, context):
-        query = update.inline_query.query
-
-        table = self.db['setpolls']
-        result = list(table.find(poll_id=query))
-        if not result:
-            table = self.db['setpolls'].table
-            statement = table.select(table.c.title.like('%{}%'.format(query)))
-            result = list(self.db.query(statement))
-
+        with self.metrics.request('inline_query'):
+            inline_results, next_offset = self.find_inline_results(update.inline_query)
+            with self.metrics.phase('telegram'):
+                if not inline_results:
+                    update.inline_query.answer(results=[],
+                                               switch_pm_text="Create a new poll",
+                                               switch_pm_parameter="start",
+                                               is_personal=True)
+                    return
+                update.inline_query.answer(inline_results, next_offset=next_offset, is_personal=True)
+
+    def find_inline_results(self, inline_query):
+        """Return the results for an inline query and the offset of the next page of results."""
+        query = inline_query.query
+        offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+        next_offset = ''
+
+        with self.metrics.phase('db_read'):
+            template = self.storage.get_template(query) if offset == 0 else None
+            result = [template] if template else []
             if not result:
-                update.inline_query.answer(results=[],
-                                           switch_pm_text="Create a new poll",
-                                           switch_pm_parameter="start")
-                return
+                result = self.storage.search_templates(inline_query.from_user.id, query, offset)
+                if len(result) == poll_search.PAGE_SIZE:
+                    next_offset = str(offset + len(result))
 
         inline_results = []
-        for res in result:
-            poll = self.deserialize(res)
-            inline_results.append(
-                InlineQueryResultArticle(
-                    id=poll['poll_id'],
-                    title=poll['title'],
-                    input_message_content=InputTextMessageContent(
-                        message_text=self.assemble_message_text(poll),
-                        parse_mode='Markdown'
-                    ),
-                    reply_markup=self.assemble_inline_keyboard(poll)
+        with self.metrics.phase('render'):
+            for res in result:
+                poll = self.deserialize(res)
+                inline_results.append(
+                    InlineQueryResultArticle(
+                        id=poll['poll_id'],
+                        title=poll['title'],
+                        input_message_content=InputTextMessageContent(
+                            message_text=self.assemble_message_text(poll),
+                            parse_mode='Markdown'
+                        ),
+                        reply_markup=self.assemble_inline_keyboard(poll)
+                    )
                 )
-            )
-        update.inline_query.answer(inline_results)
+        return inline_results, next_offset
 
     # Inline button press handler
     def button(self, update, context):
-        query = update.callback_query
-        data_dict = json.loads(update.callback_query.data)
-
-        table = self.db['setpoll_instances']
-        templates = self.db['setpolls']
-
+        with self.metrics.request('button'):
+            query = update.callback_query
+            answer, vote, followup = self.handle_button(query, context.bot)
+            with self.metrics.phase('telegram'):
+                query.answer(answer)
+            if followup is not None:
+                followup()
+            if vote is None:
+                return
+            poll, edit_kwargs, message_key, include_publish_button = vote
+
+            def send(text, reply_markup):
+                with self.metrics.phase('telegram', request='edit', poll_type=self.get_handler(poll).__name__):
+                    context.bot.edit_message_text(text=text,
+                                                  parse_mode='Markdown',
+                                                  reply_markup=reply_markup,
+                                                  **edit_kwargs)
+
+            self.schedule_edit(poll, message_key, include_publish_button, send)
+
+    def handle_button(self, query, bot):
+        """Check a button press and record its vote, everything short of the calls to Telegram.
+
+        Used by the dispatcher and the asyncio frontend alike. Returns the text to answer
+        the press with, the recorded vote as (poll, edit arguments, message key, whether
+        the message carries a publish button) or None, and a function to call once the
+        press is answered or None.
+        """
+        try:
+            data_dict = callback_data.decode(query.data)
+        except callback_data.InvalidCallbackData as e:
+            self.reject_callback(query, e)
+            return None, None, None
+        if self.over_rate_limit(query):
+            return rate_limit.REJECTED_MESSAGE, None, None
+        if data_dict.get('a') == 'x':
+            return self.export_button(query, data_dict, bot)
+
+        try:
+            poll, user, edit_kwargs, message_key, include_publish_button = self.record_vote(query, bot, data_dict)
+        except callback_data.InvalidCallbackData as e:
+            self.reject_callback(query, e)
+            return None, None, None
+        return self.get_confirmation_message(poll, user), (poll, edit_kwargs, message_key, include_publish_button), None
+
+    def record_vote(self, query, bot, data_dict):
+        """Apply the vote of a button press, given its decoded callback data.
+
+        Returns the updated poll, the voter, the arguments identifying the poll message
+        for edits, the message's key and whether the message carries a publish button.
+        """
         kwargs = {}
         include_publish_button = False
         if query.message:
-            if query.message.from_user.id == context.bot.get_me().id:
+            if query.message.from_user.id == self.get_bot_id(bot):
                 include_publish_button = True
 
             kwargs['message_id'] = query.message.message_id
             kwargs['chat_id'] = query.message.chat.id
-            result = table.find_one(message_id=query.message.message_id,
-                                    chat_id=query.message.chat.id)
-            if not result:
-                result = templates.find_one(poll_id=data_dict['id'])
-                result = dict(result)
-                result.pop('id', None)
-                result['message_id'] = query.message.message_id
-                result['chat_id'] = query.message.chat.id
-                result['votes'] = '{}'
-            import pprint
-            pprint.pprint(result)
+            message_key = (query.message.chat.id, query.message.message_id)
         elif query.inline_message_id:
             kwargs['inline_message_id'] = query.inline_message_id
-            result = table.find_one(inline_message_id=query.inline_message_id)
-            if not result:
-                result = templates.find_one(poll_id=data_dict['id'])
-                result = dict(result)
-                result.pop('id', None)
-                result['inline_message_id'] = query.inline_message_id
-                result['votes'] = '{}'
+            message_key = query.inline_message_id
 
-        poll = self.deserialize(result)
         uid_str = str(query.from_user.id)
         name = str(query.from_user.first_name)
-        handler = POLL_HANDLERS[poll['type']]
 
-        handler.handle_vote(poll['votes'], uid_str, name, data_dict)
+        with self.instance_locks.get(message_key):
+            poll = self.apply_vote(kwargs, data_dict['id'], uid_str, name, data_dict)
+        self.metrics.set_poll_type(self.get_handler(poll).__name__)
+        return poll, uid_str, kwargs, message_key, include_publish_button
+
+    def over_rate_limit(self, query):
+        """Return whether a button press is over the rate limits, and should only be answered."""
+        if self.click_limiter is None:
+            return False
+        if query.message:
+            message_key = (query.message.chat.id, query.message.message_id)
+        else:
+            message_key = query.inline_message_id
+        return not self.click_limiter.allow(query.from_user.id, message_key)
+
+    def export_button(self, query, data_dict, bot):
+        # Answered like a vote, the file is sent afterwards.
+        template = self.storage.get_template(data_dict['id'])
+        if template is None or template['user_id'] != query.from_user.id:
+            return "Only the creator of a poll can export its votes.", None, None
+
+        def send():
+            instances = self.storage.iter_instances(poll_id=template['poll_id'])
+            self.send_export(bot, query.from_user.id, template, instances)
+
+        return "Exporting the votes, the file is on its way.", None, send
+
+    def send_export(self, bot, chat_id, template, instances, format='csv'):
+        # Spooled to a temporary file, so exporting a big poll doesn't hold all its votes in memory.
+        with self.metrics.request('export'), tempfile.TemporaryFile() as outfile:
+            with self.metrics.phase('db_read'):
+                count = export.export(self.storage, POLL_HANDLERS, instances, outfile, format)
+            outfile.seek(0)
+            with self.metrics.phase('telegram'):
+                bot.send_document(chat_id, document=outfile,
+                                  filename='poll-{}.{}'.format(template['poll_id'], format),
+                                  caption="{} votes on {}".format(count, template['title']))
+
+    def reject_callback(self, query, error):
+        self.counters['invalid_callbacks'] += 1
+        logger.info('Rejected callback data %r from user %s: %s', query.data, query.from_user.id, error)
+
+    def get_handler(self, poll):
+        return POLL_HANDLERS[poll['type']]
+
+    def get_confirmation_message(self, poll, user):
+        return self.get_handler(poll).get_confirmation_message(poll, user)
+
+    def schedule_edit(self, poll, message_key, include_publish_button, send):
+        def render():
+            # With write-behind, the poll is the live instance other votes are applied to.
+            with self.instance_locks.get(message_key), \
+                    self.metrics.phase('render', request='edit', poll_type=self.get_handler(poll).__name__):
+                return self.assemble_message_text(poll), self.assemble_inline_keyboard(poll, include_publish_button)
+
+        self.render_scheduler.schedule(message_key, send, render, poll.get('version'))
+
+    def apply_vote(self, instance_kwargs, poll_id, user, name, data_dict):
+        """Record a vote on a poll instance and return the updated poll.
+
+        Concurrent writers are detected through the instance's version column, in
+        which case the vote is applied again on top of the fresh state.
+        """
+        if self.write_behind is not None:
+            return self.write_behind.apply_vote(instance_kwargs, poll_id, user, name, data_dict)
+
+        for attempt in range(MAX_VOTE_ATTEMPTS):
+            if attempt:
+                time.sleep(random.uniform(0, VOTE_RETRY_BACKOFF * attempt))
+            poll = self.load_instance(instance_kwargs, poll_id)
+            with self.metrics.phase('compute'):
+                vote_tally.ensure(poll, self.get_handler(poll))
+                self.cast_vote(poll, user, name, data_dict)
+
+            with self.metrics.phase('db_write'):
+                saved = self.save_instance(poll)
+            if saved:
+                return poll
+            self.counters['vote_conflicts'] += 1
+        raise RuntimeError("Could not record vote on {} after {} attempts".format(instance_kwargs, MAX_VOTE_ATTEMPTS))
+
+    def cast_vote(self, poll, user, name, data_dict):
+        """Apply a button press to the poll's votes and tally, and return the user's vote afterwards."""
+        handler = self.get_handler(poll)
+        # Forged presses are rejected before anything is changed.
+        if not handler.accepts_press(data_dict):
+            raise callback_data.InvalidCallbackData("Not a button of a {}".format(handler.name))
+        callback_data.check_options(data_dict, len(poll['options']))
+        old_vote = copy.deepcopy(poll['votes'].get(user))
+        handler.handle_vote(poll['votes'], user, name, data_dict)
+        handler.update_voter(poll, user, name)
+        new_vote = poll['votes'].get(user)
+        vote_tally.update(poll, handler, old_vote, new_vote)
+        return new_vote
+
+    def load_instance(self, instance_kwargs, poll_id):
+        with self.metrics.phase('db_read'):
+            result = self.storage.get_instance(instance_kwargs)
+            if not result:
+                result = dict(self.storage.get_template(poll_id))
+                result.pop('id', None)
+                result.update(instance_kwargs)
+                result['votes'] = '{}'
+                result['version'] = 0
+                result['created'] = int(time.time())
+            poll = self.deserialize(result)
+            self.vote_storage.attach(self.db, poll)
+        return poll
 
-        query.answer(handler.get_confirmation_message(poll, uid_str))
-        if 'id' in poll:
-            table.update(self.serialize(poll), ['id'])
+    def save_instance(self, poll):
+        """Write a poll instance back, unless somebody else changed it since it was loaded."""
+        ser = self.serialize(poll)
+
+        def write_votes(db, instance_id):
+            poll['id'] = instance_id
+            self.vote_storage.write(db, poll)
+
+        if 'id' not in poll:
+            ser['version'] = poll['version'] + 1
+            if self.storage.insert_instance(ser, write_votes) is None:
+                # Somebody else created this instance first.
+                return False
+            poll['version'] += 1
+            return True
+
+        values = {key: ser[key] for key in ('votes', 'tally', 'voters') if key in ser}
+        values['version'] = poll['version'] + 1
+        if not self.storage.update_instance(poll['id'], poll['version'], values, write_votes):
+            return False
+        poll['version'] += 1
+        return True
+
+    # Export command handler
+    def export_votes(self, update, context):
+        """Send the votes on a poll as a file when /export is issued.
+
+        Replying with /export to a poll message exports that message's votes, /export <poll id>
+        the votes on every message of the poll. Add ndjson for NDJSON instead of CSV.
+        """
+        message = update.message
+        format = 'ndjson' if 'ndjson' in context.args else 'csv'
+        poll_ids = [arg for arg in context.args if arg not in export.FORMATS]
+
+        if message.reply_to_message is not None:
+            reply = message.reply_to_message
+            row = self.storage.get_instance({'chat_id': reply.chat.id, 'message_id': reply.message_id})
+            template = self.storage.get_template(row['poll_id']) if row else None
+            instances = self.storage.iter_instances(instance_id=row['id']) if row else None
+        elif poll_ids:
+            template = self.storage.get_template(poll_ids[0])
+            instances = self.storage.iter_instances(poll_id=poll_ids[0])
         else:
-            table.insert(self.serialize(poll))
-        context.bot.edit_message_text(text=self.assemble_message_text(poll),
-                              parse_mode='Markdown',
-                              reply_markup=self.assemble_inline_keyboard(poll, include_publish_button),
-                              **kwargs)
+            message.reply_text("Reply with /export to a poll, or send /export followed by the poll's id.")
+            return
+
+        if template is None:
+            message.reply_text("I don't know that poll.")
+            return
+        if template['user_id'] != message.from_user.id:
+            message.reply_text("Only the creator of a poll can export its votes.")
+            return
+        # The votes go to the creator privately, even when asked for in a group.
+        self.send_export(context.bot, message.from_user.id, template, instances, format)
 
     # Help command handler
     def send_help(self, update, context):
@@ -355,16 +647,55 @@ class PollBot:
     def error(self, update, context):
         """Log Errors caused by Updates."""
         logger.warning('Update "%s" caused error "%s"', update, context.error)
+        self.metrics.inc('pollbot_dispatcher_errors_total', error=type(context.error).__name__)
+
+    def configure(self, config, migrate=True, write_behind=True, journal_suffix='', rate_limits=True):
+        """Apply the settings from the config file and connect to the database."""
+        self.render_scheduler.interval = float(config.get('edit_interval', self.render_scheduler.interval))
+        self.vote_storage = vote_storage.VOTE_STORAGES[config.get('vote_storage', 'json')]()
+        self.render_cache.max_bytes = int(float(config.get('render_cache_mb', 16)) * 1024 * 1024)
+        self.stv_exact_counting = bool(config.get('stv_exact_counting', False))
+        if rate_limits:
+            self.click_limiter = rate_limit.from_config(config.get('rate_limit'))
+        if self.click_limiter is not None:
+            self.metrics.collect('pollbot_rate_limited_total', "Button presses rejected by the rate limits",
+                                 self.click_limiter.counters, 'limit')
+
+        self.storage = storage.connect(config)
+        self.storage.log_settings()
+        if migrate:
+            schema_version = self.storage.migrate()
+            logger.info("Database schema is at version %s", schema_version)
+
+        write_behind_config = config.get('write_behind')
+        if write_behind and write_behind_config:
+            journal = write_behind_config.get('journal', config.get('db', 'pollbot') + '.journal')
+            self.write_behind = WriteBehind(self, journal + journal_suffix,
+                                            interval=float(write_behind_config.get('flush_interval', 1.0)),
+                                            max_dirty=int(write_behind_config.get('max_dirty', 500)))
+            self.write_behind.recover()
+            self.write_behind.start()
+            self.metrics.collect('pollbot_write_behind_total', "Votes journaled and instances written behind",
+                                 self.write_behind.counters, 'event')
 
     def run(self, opts):
         with open(opts.config, 'r') as configfile:
             config = yaml.load(configfile, Loader=yaml.SafeLoader)
 
-        self.db = dataset.connect('sqlite:///{}'.format(config['db']))
+        shards = int(config.get('shards', 1))
+        # With shards, button presses and so all votes are handled by the shard workers.
+        self.configure(config, write_behind=shards <= 1)
+
+        metrics_server = None
+        if config.get('metrics_port'):
+            metrics_server = metrics.MetricsServer(self.metrics, config.get('metrics_listen', '127.0.0.1'),
+                                                   int(config['metrics_port']))
+            metrics_server.start()
 
         """Start the bot."""
         # Create the EventHandler and pass it your bot's token.
-        updater = Updater(config['token'])
+        updater = Updater(config['token'], workers=int(config.get('workers', 4)))
+        self.refresh_bot_identity(updater.bot)
 
         # Conversation handler for creating polls
 
@@ -408,26 +739,96 @@ class PollBot:
         dp = updater.dispatcher
         # on different commands - answer in Telegram
         dp.add_handler(CommandHandler("help", self.send_help))
+        dp.add_handler(CommandHandler("export", self.export_votes, run_async=True))
 
         dp.add_handler(conv_handler)
 
 
         # Inline queries
-        dp.add_handler(InlineQueryHandler(self.inline_query))
+        dp.add_handler(InlineQueryHandler(self.inline_query, run_async=True))
 
         # Callback queries from button presses
-        dp.add_handler(CallbackQueryHandler(self.button))
+        router = None
+        if shards > 1:
+            router = sharding.ShardRouter(config, shards)
+            router.start()
+
+            def route_button(update, context):
+                # Rate limited here, as the presses of one user can go to several shards.
+                if self.over_rate_limit(update.callback_query):
+                    update.callback_query.answer(rate_limit.REJECTED_MESSAGE)
+                    return
+                router.route(update)
+
+            dp.add_handler(CallbackQueryHandler(route_button, run_async=True))
+        else:
+            dp.add_handler(CallbackQueryHandler(self.button, run_async=True))
 
         # log all errors
         dp.add_error_handler(self.error)
 
-        # Start the Bot
-        updater.start_polling()
-
-        # Run the bot until you press Ctrl-C or the process receives SIGINT,
-        # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
-        updater.idle()
+        webhook_config = config.get('webhook')
+        if webhook_config:
+            # Telegram POSTs updates to us, they're handled by the same dispatcher.
+            secret_token = webhook_config.get('secret_token')
+            asynchronous = None
+            if webhook_config.get('asyncio'):
+                # Inline queries, and button presses unless they go to the shards, are handled
+                # on the webhook's event loop instead.
+                asynchronous = async_bot.AsyncPollBot(self, async_bot.AsyncBotApi(config['token']), updater.bot,
+                                                      db_workers=int(webhook_config.get('db_workers', 8)),
+                                                      buttons=router is None)
+            server = webhook.WebhookServer(updater.bot, dp.update_queue,
+                                           listen=webhook_config.get('listen', '127.0.0.1'),
+                                           port=int(webhook_config.get('port', 8443)),
+                                           path=webhook_config.get('path', '/'),
+                                           secret_token=secret_token,
+                                           async_bot=asynchronous)
+            threading.Thread(target=dp.start, name='dispatcher', daemon=True).start()
+            server.start()
+            self.metrics.collect('pollbot_webhook_requests_total', "Requests to the webhook by outcome",
+                                 server.counters, 'outcome')
+            if asynchronous is not None:
+                self.metrics.collect('pollbot_async_updates_total', "Updates handled on the event loop",
+                                     asynchronous.counters, 'event')
+                self.metrics.gauge('pollbot_async_in_flight', "Updates being handled on the event loop",
+                                   lambda: asynchronous.in_flight)
+                self.metrics.gauge('pollbot_async_max_in_flight', "Most updates handled on the event loop at once",
+                                   lambda: asynchronous.max_in_flight)
+            if webhook_config.get('url'):
+                webhook.set_webhook(updater.bot, webhook_config['url'], secret_token,
+                                    int(webhook_config.get('max_connections', 40)))
+
+            webhook.wait_for_stop_signal()
+            # Pending edits may need the event loop, so they go out before the server stops.
+            self.render_scheduler.flush_all()
+            server.stop()
+            dp.stop()
+            logger.info("Webhook requests: %s", dict(server.counters))
+            if asynchronous is not None:
+                asynchronous.shutdown()
+                logger.info("Asynchronous updates: %s", dict(asynchronous.counters))
+        else:
+            # Start the Bot
+            updater.start_polling()
+
+            # Run the bot until you press Ctrl-C or the process receives SIGINT,
+            # SIGTERM or SIGABRT. This should be used most of the time, since
+            # start_polling() is non-blocking and will stop the bot gracefully.
+            updater.idle()
+
+        if router is not None:
+            router.stop()
+            logger.info("Button presses by shard: %s", dict(router.counters))
+        self.render_scheduler.flush_all()
+        if self.write_behind is not None:
+            self.write_behind.stop()
+            logger.info("Write-behind: %s", dict(self.write_behind.counters))
+        logger.info("Cached bot identity saved %s get_me calls", self.counters['get_me_calls_saved'])
+        logger.info("Message edits: %s", dict(self.render_scheduler.counters))
+        logger.info("Render cache: %s", dict(self.render_cache.counters))
+        if metrics_server is not None:
+            metrics_server.stop()
 
 
 def main(opts):
@@ -0,0 +1,76 @@
+"""Token bucket limits on how fast button presses are handled.
+
+Every user and every poll message has a bucket that holds up to ``burst``
+tokens and refills at ``rate`` tokens per second. A press takes a token from
+both the presser's and the message's bucket; if either is empty the press is
+rejected, so one user mashing a button, or a crowd piling onto one message,
+costs a quick answer instead of a database write and a message edit.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+
+REJECTED_MESSAGE = "Whoa, not so fast! Please try again in a moment."
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, time of the last refill]
+        self.buckets = OrderedDict()
+
+    def take(self, key, now):
+        """Take a token from the key's bucket, return False if it has none left. Not thread-safe."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            # The least recently used buckets go first, they would have refilled by now anyway.
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def give_back(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + 1)
+
+
+class ClickLimiter:
+    def __init__(self, user_rate=1.0, user_burst=5, message_rate=10.0, message_burst=30):
+        self.lock = threading.Lock()
+        self.users = TokenBuckets(user_rate, user_burst)
+        self.messages = TokenBuckets(message_rate, message_burst)
+        self.counters = Counter()
+
+    def allow(self, user, message_key):
+        """Return whether a press by the user on the message is within the limits."""
+        now = time.monotonic()
+        with self.lock:
+            if not self.users.take(user, now):
+                self.counters['user'] += 1
+                return False
+            if not self.messages.take(message_key, now):
+                # The press isn't handled, so it shouldn't count against the user either.
+                self.users.give_back(user)
+                self.counters['message'] += 1
+                return False
+        return True
+
+
+def from_config(config):
+    """Return a ClickLimiter for the rate_limit section of the config, or None without one."""
+    if not config:
+        return None
+    return ClickLimiter(user_rate=float(config.get('user_rate', 1.0)),
+                        user_burst=float(config.get('user_burst', 5)),
+                        message_rate=float(config.get('message_rate', 10.0)),
+                        message_burst=float(config.get('message_burst', 30)))
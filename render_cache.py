@@ -0,0 +1,69 @@
+"""A bounded cache of rendered poll messages.
+
+Rendering a poll runs its evaluation and builds the whole keyboard, but the
+result only depends on the poll's state. Poll templates never change once
+created, and every change to a poll instance bumps its version, so renders are
+cached under the template's poll_id or the instance's id and version. The least
+recently used renders are evicted once either the number of entries or their
+estimated size exceeds the limits.
+"""
+import threading
+from collections import Counter, OrderedDict
+
+
+def render_key(poll):
+    """Return the key a render of this poll is cached under, or None if it can't be cached."""
+    if 'votes' not in poll:
+        return 'template', poll['poll_id']
+    if poll.get('id') is not None and poll.get('version') is not None:
+        return 'instance', poll['id'], poll['version']
+    return None
+
+
+class RenderCache:
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.counters = Counter()
+
+    def get(self, key, render, estimate_size):
+        """Return the cached value for key, calling render() to produce it on a miss.
+
+        estimate_size(value) returns the approximate number of bytes the value takes up.
+        """
+        if key is None or self.max_entries <= 0:
+            return render()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[0]
+            self.counters['misses'] += 1
+
+        # Render outside the lock, a concurrent miss on the same key just renders twice.
+        value = render()
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return value
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.size -= old_size
+                self.counters['evictions'] += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,189 @@
+"""Coalesces poll message edits so every message is edited at most once per interval.
+
+Button presses schedule a render for the message they belong to. If the message
+was edited less than ``interval`` seconds ago, the render is deferred and any
+further presses in the meantime replace it, so only the newest state is sent.
+Renders carry the version of the poll state they show, and one that arrives
+after a newer version was already scheduled is dropped, since presses handled
+on several threads can reach the scheduler out of order. Edits that wouldn't
+change the message are skipped altogether.
+
+send() may also start the edit without waiting for it and return a
+concurrent.futures.Future of its outcome, as the asyncio frontend does. The
+message then counts as being edited until the future completes.
+"""
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, wait
+
+from telegram.error import RetryAfter, BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class RenderScheduler:
+    def __init__(self, interval=1.0, max_tracked_messages=10000):
+        self.interval = interval
+        self.max_tracked_messages = max_tracked_messages
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timers = {}
+        self.in_flight = set()
+        self.sending = {}
+        self.next_edit = {}
+        self.versions = {}
+        self.fingerprints = OrderedDict()
+        self.counters = Counter()
+
+    def schedule(self, key, send, render, version=None):
+        """Schedule an edit of the message identified by key.
+
+        render() is called when the edit goes out and returns the message text and
+        reply markup; send(text, reply_markup) performs the actual edit, or returns
+        a future of it. version is the version of the poll state render() shows, if
+        it has one.
+        """
+        with self.lock:
+            if version is not None:
+                if version < self.versions.get(key, version):
+                    self.counters['edits_stale_dropped'] += 1
+                    return
+                self.versions[key] = version
+            if key in self.pending:
+                self.counters['edits_coalesced'] += 1
+            self.pending[key] = (send, render)
+            if key in self.timers or key in self.in_flight:
+                return
+            run_now = self._arm(key)
+        if run_now:
+            self.flush(key)
+
+    def queue_depth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def flush(self, key):
+        while True:
+            with self.lock:
+                if key in self.in_flight:
+                    # The edit in progress picks up the pending render once it's done.
+                    return
+                timer = self.timers.pop(key, None)
+                if timer is not None:
+                    timer.cancel()
+                job = self.pending.pop(key, None)
+                if job is None:
+                    return
+                self.in_flight.add(key)
+
+            outcome = self._send(key, *job)
+            if isinstance(outcome, Future):
+                # Whichever thread completes the edit finishes it.
+                return
+            if not self._finish(key, job, outcome):
+                return
+
+    def flush_all(self, timeout=None):
+        """Send all pending edits, and wait for the ones sent asynchronously to complete."""
+        with self.lock:
+            keys = list(self.pending)
+        for key in keys:
+            self.flush(key)
+        with self.lock:
+            sending = list(self.sending.values())
+        wait(sending, timeout)
+
+    def _finish(self, key, job, retry_after, defer=False):
+        # Returns True if the caller should flush the key again right away.
+        with self.lock:
+            self.in_flight.discard(key)
+            self.sending.pop(key, None)
+            if retry_after is not None and key not in self.pending:
+                # Nothing newer came in while we were waiting, so try this one again.
+                self.pending[key] = job
+            self.next_edit[key] = time.monotonic() + (self.interval if retry_after is None else retry_after)
+            return key in self.pending and self._arm(key, defer)
+
+    def _arm(self, key, defer=False):
+        # Must be called with the lock held. Returns True if the caller should flush right away,
+        # unless defer is set, in which case a timer always does it.
+        delay = self.next_edit.get(key, 0) - time.monotonic()
+        if delay <= 0 and not defer:
+            return True
+        timer = threading.Timer(max(delay, 0), self.flush, [key])
+        timer.daemon = True
+        self.timers[key] = timer
+        timer.start()
+        return False
+
+    def _send(self, key, send, render):
+        # Returns how long to wait if the edit was rate limited, or the future of an asynchronous edit.
+        try:
+            text, reply_markup = render()
+            fingerprint = hash((text, reply_markup.to_json() if reply_markup else None))
+            if self.fingerprints.get(key) == fingerprint:
+                self._count('edits_skipped_unchanged')
+                return None
+
+            sent = send(text, reply_markup)
+        except Exception as e:
+            return self._failed(key, e)
+
+        if not isinstance(sent, Future):
+            self._sent(key, fingerprint)
+            return None
+
+        def done(future):
+            # Usually runs on the event loop, so anything pending is left to a timer.
+            try:
+                future.result()
+            except Exception as e:
+                retry_after = self._failed(key, e)
+            else:
+                retry_after = None
+                self._sent(key, fingerprint)
+            self._finish(key, (send, render), retry_after, defer=True)
+
+        with self.lock:
+            self.sending[key] = sent
+        sent.add_done_callback(done)
+        return sent
+
+    def _sent(self, key, fingerprint):
+        self._count('edits_sent')
+        self._remember(key, fingerprint)
+
+    def _failed(self, key, error):
+        # Returns how long to wait before retrying, if the edit was rate limited.
+        if isinstance(error, RetryAfter):
+            self._count('edits_rate_limited')
+            logger.info("Edit of %s was rate limited, retrying in %ss", key, error.retry_after)
+            return error.retry_after
+        if isinstance(error, BadRequest) and 'not modified' in str(error):
+            self._count('edits_skipped_unchanged')
+        else:
+            self._count('edit_errors')
+            logger.warning('Editing message %s caused error "%s"', key, error)
+        return None
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _remember(self, key, fingerprint):
+        with self.lock:
+            self.fingerprints[key] = fingerprint
+            self.fingerprints.move_to_end(key)
+            while len(self.fingerprints) > self.max_tracked_messages:
+                old_key, _ = self.fingerprints.popitem(last=False)
+                if old_key not in self.pending and old_key not in self.in_flight:
+                    self.next_edit.pop(old_key, None)
+                    self.versions.pop(old_key, None)
+            if len(self.next_edit) > self.max_tracked_messages:
+                now = time.monotonic()
+                for old_key in [k for k, t in self.next_edit.items() if t < now]:
+                    del self.next_edit[old_key]
+                    if old_key not in self.pending and old_key not in self.in_flight:
+                        self.versions.pop(old_key, None)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""POSTs recorded Telegram updates at a bot running in webhook mode.
+
+The input file holds one update per line, as JSON in the format Telegram sends
+it. Every update is POSTed to the webhook URL with the secret token header,
+and the response latencies are reported at the end:
+
+    python replay_updates.py -u http://127.0.0.1:8443/telegram -s mysecret -c 8 updates.ndjson
+"""
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from webhook import SECRET_TOKEN_HEADER
+
+
+def read_updates(paths):
+    updates = []
+    for path in paths:
+        with open(path, 'r') as infile:
+            for line in infile:
+                line = line.strip()
+                if line:
+                    updates.append(json.loads(line))
+    return updates
+
+
+def post_update(url, secret_token, update):
+    """POST one update, return (HTTP status, seconds until the response arrived)."""
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers, method='POST')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(opts, paths):
+    updates = read_updates(paths)
+    if opts.renumber:
+        for update_id, update in enumerate(updates, start=1):
+            update['update_id'] = update_id
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=opts.concurrency) as executor:
+        results = list(executor.map(lambda update: post_update(opts.url, opts.secret_token, update), updates))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for status, latency in results]
+    failed = [status for status, latency in results if status != 200]
+    print("{} updates in {:.2f}s ({:.1f}/s), {} failed".format(
+        len(results), elapsed, len(results) / elapsed if elapsed else 0.0, len(failed)))
+    print("latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms".format(
+        percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.9) * 1e3, percentile(latencies, 0.99) * 1e3))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] updates.ndjson...")
+    parser.add_option('-u', '--url', dest='url', default='http://127.0.0.1:8443/', type='string',
+                      help="Webhook URL of the bot")
+    parser.add_option('-s', '--secret-token', dest='secret_token', default=None, type='string',
+                      help="Secret token configured for the webhook")
+    parser.add_option('-c', '--concurrency', dest='concurrency', default=1, type='int',
+                      help="Number of updates POSTed in parallel")
+    parser.add_option('--renumber', dest='renumber', action='store_true', default=False,
+                      help="Give the updates consecutive update ids")
+    (opts, args) = parser.parse_args()
+    if not args:
+        parser.error("No update files given")
+    sys.exit(main(opts, args))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Recomputes the results of every poll instance in the database.
+
+Instances are read from the database in batches and handed to a pool of
+worker processes in chunks, which run the poll type's evaluation() on them,
+with the per-option tallies rebuilt from the votes. A summary of the time
+spent per poll type is printed at the end.
+
+The results can be saved as a snapshot, one line per instance with a hash of
+its evaluation, and compared against later, for example after fixing a bug in
+an election engine:
+
+    python retally.py -c config.yml -o before.ndjson
+    python retally.py -c config.yml -b before.ndjson
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from optparse import OptionParser
+
+import yaml
+
+import storage
+import vote_tally
+from pollbot import POLL_HANDLERS
+
+
+def read_chunks(db, chunk_size, poll_id=None):
+    """Yield lists of up to chunk_size instances, as the plain values the workers need."""
+    chunk = []
+    for row in db.iter_instances(poll_id=poll_id):
+        votes = row['votes']
+        if not votes or votes == '{}':
+            # Stored in the votes table, or no votes at all.
+            votes = json.dumps(dict(db.iter_votes(row)))
+        chunk.append({
+            'id': row['id'],
+            'poll_id': row['poll_id'],
+            'type': row['type'],
+            'title': row['title'],
+            'options': row['options'],
+            'meta': row.get('meta'),
+            'votes': votes,
+            'voters': row.get('voters'),
+        })
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def evaluate_chunk(chunk):
+    """Return (instance id, poll id, handler name, votes, evaluation hash, seconds) for every instance."""
+    results = []
+    for row in chunk:
+        start = time.perf_counter()
+        handler = POLL_HANDLERS[row['type']]
+        poll = dict(row)
+        poll['options'] = json.loads(row['options'])
+        poll['meta'] = "" if row['meta'] is None else json.loads(row['meta'])
+        poll['votes'] = json.loads(row['votes'])
+        poll['voters'] = None if row['voters'] is None else json.loads(row['voters'])
+        vote_tally.ensure(poll, handler)
+        evaluation = handler.evaluation(poll)
+        digest = hashlib.sha1(evaluation.encode('utf-8')).hexdigest()
+        results.append((row['id'], row['poll_id'], handler.__name__, len(poll['votes']), digest,
+                        time.perf_counter() - start))
+    return results
+
+
+def evaluate_all(chunks, jobs):
+    """Yield the results of all chunks, keeping only a few chunks per worker in flight."""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        for chunk in chunks:
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            pending.add(executor.submit(evaluate_chunk, chunk))
+        for future in pending:
+            yield from future.result()
+
+
+def read_snapshot(path):
+    snapshot = {}
+    with open(path, 'r') as infile:
+        for line in infile:
+            if line.strip():
+                entry = json.loads(line)
+                snapshot[entry['id']] = entry['digest']
+    return snapshot
+
+
+def main(opts):
+    logging.getLogger().setLevel(logging.WARNING)
+    with open(opts.config, 'r') as configfile:
+        config = yaml.load(configfile, Loader=yaml.SafeLoader)
+    db = storage.connect(config)
+    baseline = read_snapshot(opts.baseline) if opts.baseline else None
+    outfile = open(opts.output, 'w') if opts.output else None
+
+    instances = Counter()
+    votes = Counter()
+    seconds = Counter()
+    changed = []
+    start = time.perf_counter()
+    results = evaluate_all(read_chunks(db, opts.chunk_size, opts.poll_id), opts.jobs)
+    for instance_id, poll_id, handler_name, num_votes, digest, elapsed in results:
+        instances[handler_name] += 1
+        votes[handler_name] += num_votes
+        seconds[handler_name] += elapsed
+        if outfile is not None:
+            outfile.write(json.dumps({'id': instance_id, 'poll_id': poll_id, 'digest': digest}) + '\n')
+        if baseline is not None and baseline.get(instance_id, digest) != digest:
+            changed.append((instance_id, poll_id, handler_name))
+    elapsed = time.perf_counter() - start
+    if outfile is not None:
+        outfile.close()
+    db.close()
+
+    print("{:<50} {:>10} {:>12} {:>14}".format("poll type", "instances", "votes", "instances/s"))
+    for handler_name in sorted(instances):
+        rate = instances[handler_name] / seconds[handler_name] if seconds[handler_name] else 0.0
+        print("{:<50} {:>10} {:>12} {:>14.0f}".format(handler_name, instances[handler_name], votes[handler_name], rate))
+    total = sum(instances.values())
+    print("{} instances in {:.2f}s with {} worker processes, {:.0f} instances/s".format(
+        total, elapsed, opts.jobs, total / elapsed if elapsed else 0.0))
+
+    if baseline is not None:
+        for instance_id, poll_id, handler_name in changed:
+            print("CHANGED instance {} of poll {} ({})".format(instance_id, poll_id, handler_name))
+        print("{} of {} instances changed compared to {}".format(len(changed), total, opts.baseline))
+        return 1 if changed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-c", "--config", dest="config", default="config.yml",
+                      help="Config file of the bot whose polls are recomputed")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=os.cpu_count() or 1,
+                      help="Number of worker processes, one per core by default")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int", default=200,
+                      help="Number of instances handed to a worker at a time")
+    parser.add_option("-p", "--poll", dest="poll_id", default=None,
+                      help="Only recompute the instances of the poll with this id")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Save a snapshot of the results to this file")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None,
+                      help="Report the instances whose results differ from this snapshot")
+    opts, args = parser.parse_args()
+    sys.exit(main(opts))
@@ -1,7 +1,15 @@
-from functools import reduce
+from collections import Counter
 from base_poll_handler import *
+import vote_storage
+import vote_tally
 
-max_options = 4
+max_options = 10
+
+# Up to this many options every subset gets its own button, above it only the subsets
+# somebody voted for do, and votes are composed with the option toggle buttons.
+full_keyboard_options = 4
+max_subset_buttons = 10
+toggles_per_row = 2
 
 name = "Subset poll"
 desc = "Lets you vote for any subset of the available options"
@@ -9,18 +17,32 @@ desc = "Lets you vote for any subset of the available options"
 
 def options(poll):
     buttons = []
-    set_opts = get_subsets_of(poll['options'])
+    opts = poll['options']
+    counts = count_subsets(poll)
+
+    if len(opts) <= full_keyboard_options:
+        masks = range(1 << len(opts))
+    else:
+        popular = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        masks = sorted(mask for mask, votes in popular[:max_subset_buttons])
 
-    for set_opt in set_opts:
-        index_set = [opt['index'] for opt in set_opt]
-        title_set = [opt['text'] for opt in set_opt]
-        votes = num_votes_on_set(poll, index_set)
+    for mask in masks:
+        title_set = [opt['text'] for opt in opts if mask & (1 << opt['index'])]
+        votes = counts[mask]
         buttons.append([{
-            'text': "{}{}{}".format(get_set_opt_text(title_set), 
+            'text': "{}{}{}".format(get_set_opt_text(title_set),
                                     " - " if votes > 0 else "",
                                     votes if votes > 0 else ""),
-            'callback_data': {'i': index_set}
+            'callback_data': {'m': mask}
         }])
+
+    if len(opts) > full_keyboard_options:
+        toggles = [{
+            'text': "+/- {}".format(opt['text']),
+            'callback_data': {'a': 't', 'i': opt['index']}
+        } for opt in opts]
+        for i in range(0, len(toggles), toggles_per_row):
+            buttons.append(toggles[i:i + toggles_per_row])
     return buttons
 
 
@@ -33,14 +55,45 @@ def evaluation(poll):
 
 
 def handle_vote(votes, user, name, callback_data):
+    if not accepts_press(callback_data):
+        # Forged or corrupted button data, leave the vote as it is.
+        return
     old_vote = None
     if user in votes:
         old_vote = votes.pop(user)
-    if old_vote is not None and old_vote == callback_data['i']:
+
+    if callback_data.get('a') == 't':
+        # Add the option to or remove it from the voter's subset.
+        vote = set(old_vote or [])
+        vote ^= {callback_data['i']}
+        if vote:
+            votes[user] = sorted(vote)
+        return
+
+    if 'm' in callback_data:
+        pressed = mask_to_set(callback_data['m'])
+    else:
+        # Keyboards sent before subsets were encoded as bit masks carry the index list.
+        pressed = callback_data['i']
+    if old_vote is not None and old_vote == pressed:
         # remove old vote
         pass
     else:
-        votes[user] = callback_data['i']
+        votes[user] = pressed
+
+
+def accepts_press(callback_data):
+    if callback_data.get('a') == 't':
+        return is_option_index(callback_data.get('i'))
+    if 'm' in callback_data:
+        mask = callback_data['m']
+        return isinstance(mask, int) and 0 <= mask < 1 << max_options
+    indices = callback_data.get('i')
+    return isinstance(indices, list) and all(is_option_index(index) for index in indices)
+
+
+def is_option_index(index):
+    return isinstance(index, int) and 0 <= index < max_options
 
 
 def get_confirmation_message(poll, user):
@@ -58,29 +111,57 @@ def get_set_opt_text(title_set):
     return ','.join(title_set) if title_set else "None"
     
 
-def num_votes_on_option(poll, index):
-    if 'votes' not in poll:
-        return 0
-    votes = poll['votes']
+def selected_options(vote):
+    return [] if vote is None else list(vote)
 
-    num = 0
-    for cast_vote in votes.values():
-        if index in cast_vote:
-            num += 1
-    return num
 
+def export_vote(vote):
+    return [{'option': index} for index in vote]
 
-def num_votes_on_set(poll, index_set):
+
+def num_votes_on_option(poll, index):
+    tallied = vote_tally.count(poll, index)
+    if tallied is not None:
+        return tallied
     if 'votes' not in poll:
         return 0
     votes = poll['votes']
 
     num = 0
     for cast_vote in votes.values():
-        if cast_vote == index_set:
+        if index in cast_vote:
             num += 1
     return num
 
 
-def get_subsets_of(some_set):
-    return reduce(lambda z, x: z + [y + [x] for y in z], some_set, [[]])
+def num_votes_on_set(poll, index_set):
+    return count_subsets(poll)[set_to_mask(index_set, len(poll['options']))]
+
+
+def count_subsets(poll):
+    """Return a Counter of the number of votes on every subset, keyed by the subset's bit mask."""
+    counts = Counter()
+    votes = poll.get('votes', {})
+    num_options = len(poll['options'])
+    for cast_vote, num in vote_storage.grouped_payloads(votes):
+        counts[set_to_mask(cast_vote, num_options)] += num
+    return counts
+
+
+def set_to_mask(index_set, num_options=max_options):
+    """Return the bit mask of a subset, leaving out indices that aren't options of the poll."""
+    mask = 0
+    for index in index_set:
+        if 0 <= index < num_options:
+            mask |= 1 << index
+    return mask
+
+
+def mask_to_set(mask):
+    index_set = []
+    index = 0
+    while mask >> index:
+        if mask & (1 << index):
+            index_set.append(index)
+        index += 1
+    return index_set
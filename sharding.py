@@ -0,0 +1,95 @@
+"""Spreads button presses over several worker processes.
+
+The front process receives all updates. Callback queries are routed to one of
+the shard workers by a stable hash of the poll instance they belong to, so
+every instance is only ever written by one process, which can keep it in
+memory (see write_behind.py) without racing other processes. Everything else,
+such as creating polls and inline queries, stays with the front process.
+"""
+import logging
+import multiprocessing
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+
+def instance_key(data):
+    """Return the key of the poll instance a callback query update belongs to."""
+    query = data['callback_query']
+    if query.get('message'):
+        return '{}:{}'.format(query['message']['chat']['id'], query['message']['message_id'])
+    return query['inline_message_id']
+
+
+def shard_for(key, shards):
+    # crc32 rather than hash(), which differs between processes.
+    return zlib.crc32(key.encode()) % shards
+
+
+class ShardRouter:
+    def __init__(self, config, shards, bot_factory=None):
+        # Workers are spawned rather than forked, so they don't inherit the front's database connections.
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue() for _ in range(shards)]
+        self.processes = [context.Process(target=run_worker, args=(shard, queue, config, bot_factory),
+                                          name='shard-{}'.format(shard))
+                          for shard, queue in enumerate(self.queues)]
+        self.counters = Counter()
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info("Started %s shard workers", len(self.processes))
+
+    def route(self, update, context=None):
+        """Hand a callback query to its shard. Can be registered as a CallbackQueryHandler callback."""
+        data = update if isinstance(update, dict) else update.to_dict()
+        shard = shard_for(instance_key(data), len(self.queues))
+        self.queues[shard].put(data)
+        self.counters['shard_{}'.format(shard)] += 1
+
+    def stop(self):
+        """Let the workers finish the updates they were sent and wait for them to exit."""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def run_worker(shard, update_queue, config, bot_factory=None):
+    # Imported here, the front process imports this module from pollbot.
+    from pollbot import PollBot
+
+    logging.basicConfig(format='%(asctime)s - shard {} - %(name)s - %(levelname)s - %(message)s'.format(shard),
+                        level=logging.INFO)
+    bot = bot_factory() if bot_factory is not None else Bot(config['token'])
+
+    pollbot = PollBot()
+    # The front process has migrated the database already, and applies the rate limits.
+    pollbot.configure(config, migrate=False, journal_suffix='.shard{}'.format(shard), rate_limits=False)
+    pollbot.refresh_bot_identity(bot)
+    context = SimpleNamespace(bot=bot, user_data={})
+
+    def handle(update):
+        try:
+            pollbot.button(update, context)
+        except Exception as e:
+            logger.warning('Update "%s" caused error "%s"', update, e)
+
+    with ThreadPoolExecutor(max_workers=int(config.get('workers', 4))) as executor:
+        while True:
+            data = update_queue.get()
+            if data is None:
+                break
+            executor.submit(handle, Update.de_json(data, bot))
+
+    pollbot.render_scheduler.flush_all()
+    if pollbot.write_behind is not None:
+        pollbot.write_behind.stop()
+    logger.info("Message edits: %s", dict(pollbot.render_scheduler.counters))
+    pollbot.storage.close()
@@ -0,0 +1,176 @@
+"""Where poll templates and poll instances are stored.
+
+PollBot only talks to a Storage, which deals in rows as PollBot.serialize
+produces them. SqliteStorage keeps everything in a local SQLite file and
+searches poll titles through an FTS5 index. PostgresStorage keeps them in a
+PostgreSQL database that several bot processes can share, and searches with
+PostgreSQL's own full-text search. ``connect(config)`` picks one: with a
+``database_url`` the bot uses PostgreSQL, otherwise the SQLite file at ``db``.
+"""
+import json
+import logging
+
+from sqlalchemy.exc import IntegrityError
+
+import database
+import migrations
+import poll_search
+import vote_storage
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_TABLE = 'setpolls'
+INSTANCES_TABLE = 'setpoll_instances'
+
+
+class Storage:
+    """The operations PollBot needs, implemented on a dataset database."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def transaction(self):
+        """Return a context manager; everything stored within it is committed together."""
+        return self.db
+
+    def migrate(self):
+        return migrations.migrate(self.db)
+
+    def log_settings(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+    def create_template(self, row):
+        with self.db as tx:
+            row_id = tx[TEMPLATES_TABLE].insert(row)
+            self.index_template(tx, row_id, row)
+        return row_id
+
+    def index_template(self, tx, row_id, row):
+        pass
+
+    def get_template(self, poll_id):
+        return self.db[TEMPLATES_TABLE].find_one(poll_id=poll_id)
+
+    def search_templates(self, user_id, query, offset=0, limit=poll_search.PAGE_SIZE):
+        raise NotImplementedError
+
+    def get_instance(self, instance_kwargs):
+        return self.db[INSTANCES_TABLE].find_one(**instance_kwargs)
+
+    def insert_instance(self, row, write_votes=None):
+        """Insert a new instance and return its id, or None if it exists already.
+
+        write_votes(db, instance_id) is called in the same transaction to store the votes.
+        """
+        try:
+            with self.db as tx:
+                instance_id = tx[INSTANCES_TABLE].insert(row)
+                if write_votes is not None:
+                    write_votes(tx, instance_id)
+        except IntegrityError:
+            return None
+        return instance_id
+
+    def update_instance(self, instance_id, version, values, write_votes=None):
+        """Update an instance, unless it's no longer at the given version. Returns whether it was updated."""
+        table = self.db[INSTANCES_TABLE].table
+        statement = table.update() \
+            .where(table.c.id == instance_id) \
+            .where(table.c.version == version) \
+            .values(**values)
+        with self.db as tx:
+            updated = tx.executable.execute(statement).rowcount
+            if updated == 1 and write_votes is not None:
+                write_votes(tx, instance_id)
+        return updated == 1
+
+    def iter_instances(self, poll_id=None, instance_id=None, since=None, until=None, batch_size=500):
+        """Yield instance rows in the order they were created, reading batch_size rows at a time.
+
+        since and until select a range of creation times, as Unix timestamps.
+        """
+        conditions = ['id > :after']
+        params = {'limit': batch_size}
+        for column, operator, value in (('poll_id', '=', poll_id), ('id', '=', instance_id),
+                                        ('created', '>=', since), ('created', '<', until)):
+            if value is not None:
+                name = '{}_{}'.format(column, len(params))
+                conditions.append('{} {} :{}'.format(column, operator, name))
+                params[name] = value
+
+        after = 0
+        while True:
+            rows = list(self.db.query('SELECT * FROM {} WHERE {} ORDER BY id LIMIT :limit'
+                                      .format(INSTANCES_TABLE, ' AND '.join(conditions)), after=after, **params))
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            after = rows[-1]['id']
+
+    def iter_votes(self, row):
+        """Yield the (user, vote) pairs of an instance row, as they are read from the database."""
+        votes = json.loads(row['votes'] or '{}')
+        if votes:
+            # Votes still in the JSON column are the current ones, see VoteTable.
+            yield from votes.items()
+            return
+        for vote in self.db.query('SELECT user_id, payload FROM {} WHERE instance_id = :instance_id'
+                                  .format(vote_storage.VOTES_TABLE), instance_id=row['id']):
+            yield vote['user_id'], json.loads(vote['payload'])
+
+    def write_instance(self, row):
+        """Insert or overwrite an instance without checking its version. Use within transaction()."""
+        if row.get('id') is None:
+            row = dict(row)
+            row.pop('id', None)
+            return self.db[INSTANCES_TABLE].insert(row)
+        self.db[INSTANCES_TABLE].update(row, ['id'])
+        return row['id']
+
+
+class SqliteStorage(Storage):
+    name = 'sqlite'
+
+    def log_settings(self):
+        database.log_settings(self.db)
+
+    def index_template(self, tx, row_id, row):
+        poll_search.index_poll(tx, row_id, row)
+
+    def search_templates(self, user_id, query, offset=0, limit=poll_search.PAGE_SIZE):
+        return poll_search.search(self.db, user_id, query, offset, limit)
+
+
+class PostgresStorage(Storage):
+    name = 'postgresql'
+
+    def log_settings(self):
+        row = next(iter(self.db.query('SHOW server_version')))
+        logger.info("PostgreSQL server version %s", row['server_version'])
+
+    def search_templates(self, user_id, query, offset=0, limit=poll_search.PAGE_SIZE):
+        limit = min(limit, poll_search.PAGE_SIZE)
+        terms = poll_search.TERM_PATTERN.findall(query)
+        if not terms:
+            return list(self.db.query("SELECT * FROM setpolls WHERE user_id = :user_id "
+                                      "ORDER BY id DESC LIMIT :limit OFFSET :offset",
+                                      user_id=user_id, limit=limit, offset=offset))
+
+        # Prefix matches on every term, like the SQLite index. The expression matches ix_setpolls_search.
+        tsquery = ' & '.join("{}:*".format(term) for term in terms)
+        return list(self.db.query("SELECT * FROM setpolls WHERE user_id = :user_id AND "
+                                  "{document} @@ to_tsquery('simple', :tsquery) "
+                                  "ORDER BY ts_rank({document}, to_tsquery('simple', :tsquery)) DESC, id DESC "
+                                  "LIMIT :limit OFFSET :offset"
+                                  .format(document=migrations.POSTGRES_SEARCH_DOCUMENT),
+                                  user_id=user_id, tsquery=tsquery, limit=limit, offset=offset))
+
+
+def connect(config):
+    database_url = config.get('database_url')
+    if database_url:
+        return PostgresStorage(database.connect_url(database_url, config.get('pool_size', 16)))
+    return SqliteStorage(database.connect_sqlite(config['db'], config.get('sqlite')))
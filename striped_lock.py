@@ -0,0 +1,14 @@
+"""A fixed pool of locks shared out by key hash.
+
+Keys that hash to the same stripe share a lock, so the memory used doesn't grow
+with the number of keys, while work on different keys mostly runs in parallel.
+"""
+import threading
+
+
+class StripedLock:
+    def __init__(self, stripes=64):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def get(self, key):
+        return self.locks[hash(key) % len(self.locks)]
@@ -1,5 +1,5 @@
 from base_poll_handler import *
-import math
+from fractions import Fraction
 
 name = "Single transferable vote poll"
 desc = "Similar to instant runoff, but multiple choices will be elected."
@@ -50,15 +50,9 @@ def evaluation(poll):
     quota = int(float(len(votes))/float(numopts + 1)) + 1
 
     if votes:
-        candidate_info = {}
-        for candidate in candidates:
-            candidate_info[candidate] = {
-                'votes': {},
-                'status': HOPEFUL,
-            }
-        initialize_votes(candidate_info, votes)
-
-        elected, ties = run_election(quota, numopts, votes, candidate_info)
+        # Polls created with exact counting count with fractions, so results don't depend on rounding.
+        exact = bool(poll['meta'].get('exact_counting'))
+        elected, ties = run_election(quota, numopts, list(votes.values()), candidates, exact)
 
         elected_names = [get_option_name_by_index(poll, el) for el in elected]
         tied_names = [get_option_name_by_index(poll, el) for el in ties]
@@ -85,120 +79,114 @@ def evaluation(poll):
     return body
 
 
-def initialize_votes(candidate_info, votes):
-    for voter, vote in votes.items():
-        candidate_info[vote[0]]['votes'][voter] = 1.0
-
-
-def run_election(quota, seats, votes, candidate_info):
-    if len(candidate_info) <= seats:
-        return list(candidate_info.keys()), []
-
-    elected_candidates = count_candidate_votes_and_check_for_elections(candidate_info, quota)
-    if not elected_candidates:
-        eliminated_candidates = eliminate_lowest_candidates(candidate_info)
-    transfer_votes(votes, quota, candidate_info)
-
-    (hopeful, elected, eliminated) = count_candidate_types(candidate_info)
-    hopeful_candidates = get_hopeful_candidates(candidate_info)
-
-    if hopeful + elected <= seats:
-        ties = []
-        if hopeful + elected < seats:
-            ties = eliminated_candidates
-        return elected_candidates + hopeful_candidates, ties
+def run_election(quota, seats, votes, candidates, exact=False):
+    """Elect up to seats candidates. Returns the elected candidates and the candidates tied for the last seat.
+
+    Candidates and ballots are numbered, and every candidate keeps a pile mapping
+    ballot numbers to the weight that ballot currently gives them. Each round the
+    piles of elected and eliminated candidates are transferred, and only piles
+    that changed are counted again. Every pile entry remembers how far along its
+    ballot the next hopeful preference was last found, so transfers don't search
+    the ballot from the start again.
+    """
+    if len(candidates) <= seats:
+        return list(candidates), []
+
+    one = Fraction(1) if exact else 1.0
+    zero = Fraction(0) if exact else 0.0
+    if candidates == list(range(len(candidates))):
+        # Option indices already are positions, so the ballots can be used as they are.
+        ballots = votes
     else:
-        el, ti = run_election(quota, seats, votes, candidate_info)
-        return elected_candidates + el, ti
-
-
-def count_candidate_votes_and_check_for_elections(candidate_info, quota):
-    elected_candidates = []
-    for candidate, info in candidate_info.items():
-        candidate_votes = 0.0
-        for vote, value in info['votes'].items():
-            candidate_votes += value
-        if candidate_votes >= quota and info['status'] == HOPEFUL:
-            elected_candidates.append(candidate)
-            info['status'] = ELECTED
-        info['curr_vote_count'] = candidate_votes
-
-    return elected_candidates
-
-
-def transfer_votes(votes, quota, candidate_info):
-    for candidate, info in candidate_info.items():
-        if info['status'] == ELIMINATED:
+        slots = {candidate: i for i, candidate in enumerate(candidates)}
+        ballots = [[slots[preference] for preference in vote] for vote in votes]
+
+    status = [HOPEFUL] * len(candidates)
+    piles = [{} for _ in candidates]
+    positions = [{} for _ in candidates]
+    totals = [zero] * len(candidates)
+    for ballot, preferences in enumerate(ballots):
+        piles[preferences[0]][ballot] = one
+        positions[preferences[0]][ballot] = 0
+    changed = set(range(len(candidates)))
+
+    elected = []
+    # Every round elects or eliminates at least one candidate.
+    for _ in range(len(candidates)):
+        for slot in changed:
+            total = zero
+            for weight in piles[slot].values():
+                total += weight
+            totals[slot] = total
+        changed = set()
+
+        newly_elected = [slot for slot, votes_for in enumerate(totals)
+                         if votes_for >= quota and status[slot] == HOPEFUL]
+        for slot in newly_elected:
+            status[slot] = ELECTED
+
+        eliminated = []
+        if not newly_elected:
+            hopeful = [slot for slot in range(len(candidates)) if status[slot] == HOPEFUL]
+            if hopeful:
+                minimum = min(totals[slot] for slot in hopeful)
+                eliminated = [slot for slot in hopeful if totals[slot] == minimum]
+            for slot in eliminated:
+                status[slot] = ELIMINATED
+
+        if not newly_elected and not eliminated:
+            break
+
+        transfer_votes(quota, ballots, positions, status, piles, totals, changed, exact)
+
+        elected += newly_elected
+        hopeful = [slot for slot in range(len(candidates)) if status[slot] == HOPEFUL]
+        if len(hopeful) + status.count(ELECTED) <= seats:
+            ties = []
+            if len(hopeful) + status.count(ELECTED) < seats:
+                ties = eliminated
+            return [candidates[slot] for slot in elected + hopeful], [candidates[slot] for slot in ties]
+
+    hopeful = [slot for slot in range(len(candidates)) if status[slot] == HOPEFUL]
+    return [candidates[slot] for slot in elected + hopeful], []
+
+
+def transfer_votes(quota, ballots, positions, status, piles, totals, changed, exact):
+    for slot, pile in enumerate(piles):
+        if status[slot] == HOPEFUL or not pile:
+            # hopeful candidates retain all votes, no transfer
+            continue
+        if status[slot] == ELIMINATED:
             retain_ratio = 0
             transfer_ratio = 1
-        if info['status'] == ELECTED:
-            retain_ratio = quota / info['curr_vote_count']
+        else:
+            retain_ratio = (Fraction(quota) if exact else quota) / totals[slot]
             transfer_ratio = 1 - retain_ratio
-        if info['status'] == HOPEFUL:
-            # retain all votes, no transfer
-            continue
-
-        del_voters = []
-        for voter, vote_value in info['votes'].items():
-            if retain_ratio == 0:
-                # schedule for deletion
-                del_voters.append(voter)
-            else:
-                info['votes'][voter] = vote_value * retain_ratio
-            transfer_value = vote_value * transfer_ratio
-            vote = votes[voter]
-            idx = vote.index(candidate)
-            while idx < len(vote) \
-                    and candidate_info[vote[idx]]['status'] != HOPEFUL:
+        changed.add(slot)
+
+        found = positions[slot]
+        for ballot, weight in pile.items():
+            if retain_ratio != 0:
+                pile[ballot] = weight * retain_ratio
+            # Candidates never become hopeful again, so the next hopeful
+            # preference can only be further along than where it was last found.
+            preferences = ballots[ballot]
+            idx = found[ballot]
+            while idx < len(preferences) and status[preferences[idx]] != HOPEFUL:
                 idx += 1
-            if idx < len(vote):
-                candidate_info[vote[idx]]['votes'][voter] = transfer_value
-            else:
-                pass  # vote is lost
-        for del_voter in del_voters:
-            del info['votes'][del_voter]
+            found[ballot] = idx
+            if idx < len(preferences):
+                piles[preferences[idx]][ballot] = weight * transfer_ratio
+                positions[preferences[idx]].setdefault(ballot, idx)
+                changed.add(preferences[idx])
+            # otherwise the vote is lost
+        if retain_ratio == 0:
+            pile.clear()
+            found.clear()
 
 
-def eliminate_lowest_candidates(candidate_info):
-    minimum = float('inf')
-    lowest = []
-
-    for candidate, info in candidate_info.items():
-        if info['status'] == HOPEFUL:
-            if info['curr_vote_count'] < minimum:
-                lowest = [candidate]
-                minimum = info['curr_vote_count']
-            elif info['curr_vote_count'] == minimum:
-                lowest.append(candidate)
-
-    for candidate in lowest:
-        candidate_info[candidate]['status'] = ELIMINATED
-
-    return lowest
-
-
-def count_candidate_types(candidate_info):
-    hopeful, elected, eliminated = [0, 0, 0]
-
-    for candidate, info in candidate_info.items():
-        if info['status'] == HOPEFUL:
-            hopeful += 1
-        elif info['status'] == ELECTED:
-            elected += 1
-        elif info['status'] == ELIMINATED:
-            eliminated += 1
-
-    return hopeful, elected, eliminated
-
-
-def get_hopeful_candidates(candidate_info):
-    hopeful_candidates = []
-
-    for candidate, info in candidate_info.items():
-        if info['status'] == HOPEFUL:
-            hopeful_candidates.append(candidate)
-
-    return hopeful_candidates
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C',))
 
 
 def handle_vote(votes, user, name, callback_data):
@@ -220,6 +208,10 @@ def handle_vote(votes, user, name, callback_data):
         votes[user] = old_vote
 
 
+def export_vote(vote):
+    return [{'option': index, 'rank': rank} for rank, index in enumerate(vote, start=1)]
+
+
 def get_confirmation_message(poll, user):
     votes = poll['votes']
     if user in votes:
@@ -0,0 +1,34 @@
+"""Checks the election engines against the reference implementations in election_reference.py.
+
+The random polls are the ones ``benchmark.py --verify`` uses, with a fixed seed,
+so a failure can be reproduced with the same seed there.
+"""
+import unittest
+
+import benchmark
+
+SEED = 1
+TRIALS = 500
+
+
+class ElectionEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mismatches = benchmark.verify_engines(TRIALS, SEED)
+
+    def assertMatchesReference(self, engine):
+        trials = [trial for name, trial, poll, expected, actual in self.mismatches if name == engine]
+        self.assertEqual(trials, [], "{} differs from the reference in these trials".format(engine))
+
+    def test_instant_runoff(self):
+        self.assertMatchesReference('instant_runoff')
+
+    def test_tie_break_instant_runoff(self):
+        self.assertMatchesReference('tie_break_instant_runoff')
+
+    def test_single_transferable_vote(self):
+        self.assertMatchesReference('stv')
+
+
+if __name__ == '__main__':
+    unittest.main()
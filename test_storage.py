@@ -0,0 +1,248 @@
+"""Runs the Storage operations and the schema migrations against a real database.
+
+The SQLite tests always run. The PostgreSQL tests run against the database
+POLLBOT_TEST_DATABASE_URL points to, if it is set, for example:
+
+    POLLBOT_TEST_DATABASE_URL=postgresql://pollbot@localhost/pollbot_test python -m unittest test_storage
+
+Otherwise they start a throwaway server in a temporary directory with initdb and
+pg_ctl, if those are on the PATH, and are skipped if they aren't. Everything the
+tests create is kept in a schema of its own, which is dropped afterwards.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import unittest
+import uuid
+
+import database
+import migrations
+import storage
+import vote_storage
+
+DATABASE_URL_VARIABLE = 'POLLBOT_TEST_DATABASE_URL'
+POSTGRES_BINARIES = ('initdb', 'pg_ctl')
+
+
+def template_row(user_id=7, title="Where do we eat?", options=("Pizza", "Ramen")):
+    return {
+        'poll_id': str(uuid.uuid4()),
+        'title': title,
+        'type': 0,
+        'options': json.dumps([{'text': text, 'index': i} for i, text in enumerate(options)]),
+        'meta': json.dumps({}),
+        'user_id': user_id,
+        'created': 1600000000,
+    }
+
+
+def instance_row(template, inline_message_id, votes=None):
+    row = dict(template)
+    row.update({
+        'inline_message_id': inline_message_id,
+        'votes': json.dumps(votes or {}),
+        'tally': None,
+        'version': 1,
+    })
+    return row
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_postgres(directory):
+    """Start a PostgreSQL server that only listens on a socket in the directory, and return its URL."""
+    data = os.path.join(directory, 'data')
+    port = free_port()
+    subprocess.run(['initdb', '-D', data, '-U', 'pollbot', '--auth=trust'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    subprocess.run(['pg_ctl', '-D', data, '-l', os.path.join(directory, 'postgres.log'), '-w',
+                    '-o', "-p {} -k {} -c listen_addresses=''".format(port, directory), 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+    return 'postgresql://pollbot@/postgres?host={}&port={}'.format(directory, port)
+
+
+def stop_postgres(directory):
+    subprocess.run(['pg_ctl', '-D', os.path.join(directory, 'data'), '-m', 'fast', '-w', 'stop'],
+                   check=False, stdout=subprocess.DEVNULL)
+
+
+class StorageTests:
+    """The tests every Storage passes. Subclasses connect self.storage in setUp."""
+
+    def test_migrations_are_applied_once(self):
+        self.assertEqual(migrations.get_schema_version(self.storage.db), migrations.SCHEMA_VERSION)
+        self.assertEqual(self.storage.migrate(), migrations.SCHEMA_VERSION)
+
+    def test_templates(self):
+        template = template_row()
+        row_id = self.storage.create_template(template)
+        self.assertEqual(self.storage.get_template(template['poll_id'])['id'], row_id)
+        self.assertIsNone(self.storage.get_template(str(uuid.uuid4())))
+
+        self.storage.create_template(template_row(user_id=8, title="Where do we sleep?"))
+        found = self.storage.search_templates(7, "eat")
+        self.assertEqual([row['poll_id'] for row in found], [template['poll_id']])
+        self.assertEqual(self.storage.search_templates(7, "sleep"), [])
+        self.assertEqual(len(self.storage.search_templates(7, "")), 1)
+
+    def test_insert_instance_once(self):
+        template = template_row()
+        self.storage.create_template(template)
+        written = []
+        instance_id = self.storage.insert_instance(instance_row(template, 'a'),
+                                                   lambda db, row_id: written.append(row_id))
+        self.assertIsNotNone(instance_id)
+        self.assertEqual(written, [instance_id])
+        # A second first click on the same message loses the race.
+        self.assertIsNone(self.storage.insert_instance(instance_row(template, 'a')))
+        self.assertEqual(self.storage.get_instance({'inline_message_id': 'a'})['id'], instance_id)
+
+    def test_update_instance_checks_version(self):
+        template = template_row()
+        self.storage.create_template(template)
+        instance_id = self.storage.insert_instance(instance_row(template, 'a'))
+
+        self.assertTrue(self.storage.update_instance(instance_id, 1, {'votes': '{"1": 0}', 'version': 2}))
+        self.assertFalse(self.storage.update_instance(instance_id, 1, {'votes': '{"2": 1}', 'version': 2}))
+        row = self.storage.get_instance({'inline_message_id': 'a'})
+        self.assertEqual((row['version'], json.loads(row['votes'])), (2, {'1': 0}))
+
+    def test_votes_table_upserts(self):
+        template = template_row()
+        self.storage.create_template(template)
+        instance_id = self.storage.insert_instance(instance_row(template, 'a'))
+        poll = {'id': instance_id, 'votes': {}}
+        table_storage = vote_storage.TableVoteStorage()
+        table_storage.attach(self.storage.db, poll)
+
+        poll['votes']['1'] = 0
+        poll['votes']['2'] = 1
+        table_storage.write(self.storage.db, poll)
+        poll['votes']['1'] = 1
+        del poll['votes']['2']
+        self.assertTrue(self.storage.update_instance(instance_id, 1, {'version': 2},
+                                                     lambda db, row_id: table_storage.write(db, poll)))
+
+        row = self.storage.get_instance({'inline_message_id': 'a'})
+        self.assertEqual(dict(self.storage.iter_votes(row)), {'1': 1})
+        reloaded = {'id': instance_id, 'votes': {}}
+        table_storage.attach(self.storage.db, reloaded)
+        self.assertEqual(list(reloaded['votes'].grouped()), [(1, 1)])
+
+    def test_json_storage_reads_votes_table(self):
+        template = template_row()
+        self.storage.create_template(template)
+        instance_id = self.storage.insert_instance(instance_row(template, 'a'))
+        poll = {'id': instance_id, 'votes': {}}
+        table_storage = vote_storage.TableVoteStorage()
+        table_storage.attach(self.storage.db, poll)
+        poll['votes']['1'] = 0
+        table_storage.write(self.storage.db, poll)
+
+        # The vote storage was switched back to json.
+        json_storage = vote_storage.JsonVoteStorage()
+        poll = {'id': instance_id, 'votes': {}}
+        json_storage.attach(self.storage.db, poll)
+        self.assertEqual(poll['votes'], {'1': 0})
+        poll['votes']['2'] = 1
+        values = {'votes': json_storage.dump(poll['votes']), 'version': 2}
+        self.assertTrue(self.storage.update_instance(instance_id, 1, values,
+                                                     lambda db, row_id: json_storage.write(db, poll)))
+        row = self.storage.get_instance({'inline_message_id': 'a'})
+        self.assertEqual(dict(self.storage.iter_votes(row)), {'1': 0, '2': 1})
+        self.assertEqual(self.storage.db[vote_storage.VOTES_TABLE].count(instance_id=instance_id), 0)
+
+    def test_iter_instances(self):
+        template = template_row()
+        self.storage.create_template(template)
+        ids = []
+        for i in range(5):
+            row = instance_row(template, 'm{}'.format(i), {'1': i % 2})
+            row['created'] = 1600000000 + i
+            ids.append(self.storage.insert_instance(row))
+
+        rows = list(self.storage.iter_instances(poll_id=template['poll_id'], batch_size=2))
+        self.assertEqual([row['id'] for row in rows], ids)
+        rows = list(self.storage.iter_instances(since=1600000001, until=1600000003))
+        self.assertEqual([row['id'] for row in rows], ids[1:3])
+        self.assertEqual(list(self.storage.iter_votes(rows[0])), [('1', 1)])
+
+    def test_write_instance(self):
+        template = template_row()
+        self.storage.create_template(template)
+        with self.storage.transaction():
+            instance_id = self.storage.write_instance(dict(instance_row(template, 'a'), id=None))
+        with self.storage.transaction():
+            self.storage.write_instance(dict(instance_row(template, 'a', {'1': 1}), id=instance_id, version=5))
+        row = self.storage.get_instance({'inline_message_id': 'a'})
+        self.assertEqual((row['id'], row['version'], json.loads(row['votes'])), (instance_id, 5, {'1': 1}))
+
+
+class SqliteStorageTest(StorageTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pollbot-test-')
+        self.storage = storage.connect({'db': os.path.join(self.directory, 'votes.db')})
+        self.storage.migrate()
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+@unittest.skipUnless(os.environ.get(DATABASE_URL_VARIABLE) or all(shutil.which(b) for b in POSTGRES_BINARIES),
+                     "{} is not set and PostgreSQL is not installed".format(DATABASE_URL_VARIABLE))
+class PostgresStorageTest(StorageTests, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = None
+        cls.url = os.environ.get(DATABASE_URL_VARIABLE)
+        if cls.url:
+            return
+        cls.server = tempfile.mkdtemp(prefix='pollbot-postgres-')
+        try:
+            cls.url = start_postgres(cls.server)
+        except subprocess.CalledProcessError as e:
+            # initdb refuses to run as root, for one.
+            cls.tearDownClass()
+            raise unittest.SkipTest("Could not start PostgreSQL: {}".format(e))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server is not None:
+            stop_postgres(cls.server)
+            shutil.rmtree(cls.server, ignore_errors=True)
+            cls.server = None
+
+    def setUp(self):
+        url = self.url
+        self.schema = 'pollbot_test_{}'.format(uuid.uuid4().hex[:12])
+        self.admin = database.connect_url(url, pool_size=1)
+        self.admin.query('CREATE SCHEMA {}'.format(self.schema))
+        # Every connection of the storage works in the test schema.
+        separator = '&' if '?' in url else '?'
+        self.storage = storage.connect({
+            'database_url': '{}{}options=-csearch_path%3D{}'.format(url, separator, self.schema),
+        })
+        self.assertIsInstance(self.storage, storage.PostgresStorage)
+        self.storage.migrate()
+
+    def tearDown(self):
+        self.storage.close()
+        self.admin.query('DROP SCHEMA {} CASCADE'.format(self.schema))
+        self.admin.close()
+
+    def test_search_index_exists(self):
+        rows = self.storage.db.query("SELECT indexname FROM pg_indexes WHERE schemaname = :schema",
+                                     schema=self.schema)
+        self.assertIn('ix_setpolls_search', [row['indexname'] for row in rows])
+
+
+if __name__ == '__main__':
+    unittest.main()
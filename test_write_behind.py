@@ -0,0 +1,135 @@
+"""Checks that write-behind loses no acknowledged votes when the bot crashes.
+
+A crash is simulated by dropping the WriteBehind without a final flush, and
+starting a new bot on the same database and journal.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import pollbot
+import vote_tally
+from write_behind import WriteBehind
+
+MESSAGE = {'inline_message_id': 'message'}
+
+
+class WriteBehindRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pollbot-test-')
+        self.db_path = os.path.join(self.directory, 'votes.db')
+        self.journal_path = os.path.join(self.directory, 'votes.journal')
+        self.poll_id = str(uuid.uuid4())
+        self.bot = self.start_bot()
+        self.bot.storage.create_template({
+            'poll_id': self.poll_id,
+            'title': "Where do we eat?",
+            'type': pollbot.POLL_TYPE_BASIC,
+            'options': json.dumps([{'text': text, 'index': i} for i, text in enumerate(["Pizza", "Ramen"])]),
+            'meta': json.dumps({}),
+            'user_id': 7,
+        })
+
+    def tearDown(self):
+        for bot in self.bots:
+            bot.write_behind.journal.close()
+            bot.storage.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start_bot(self):
+        if not hasattr(self, 'bots'):
+            self.bots = []
+        bot = pollbot.PollBot()
+        bot.configure({'db': self.db_path}, write_behind=False)
+        # Not started, so nothing is flushed unless a test asks for it.
+        bot.write_behind = WriteBehind(bot, self.journal_path)
+        self.bots.append(bot)
+        return bot
+
+    def vote(self, user, option):
+        self.bot.write_behind.apply_vote(MESSAGE, self.poll_id, user, "Voter " + user,
+                                         {'i': option, 'id': self.poll_id})
+
+    def restart(self):
+        """Crash the current bot and recover the votes in a new one."""
+        self.bot.write_behind.journal.close()
+        self.bot = self.start_bot()
+        self.bot.write_behind.recover()
+        return self.stored_poll()
+
+    def stored_poll(self):
+        poll = self.bot.deserialize(self.bot.storage.get_instance(MESSAGE))
+        handler = self.bot.get_handler(poll)
+        self.assertEqual(poll['tally'], vote_tally.build(poll, handler))
+        return poll
+
+    def test_crash_before_flush(self):
+        self.vote('1', 0)
+        self.vote('2', 1)
+        self.vote('1', 1)
+        self.vote('3', 0)
+        self.vote('3', 0)
+
+        poll = self.restart()
+        self.assertEqual(poll['votes'], {'1': 1, '2': 1})
+        # The replayed votes are in the database, so the journal is empty again.
+        self.assertEqual(list(self.bot.write_behind.journal.entries()), [])
+
+    def test_torn_last_line(self):
+        self.vote('1', 0)
+        self.vote('2', 1)
+        # The process died while writing the next entry, before the click was acknowledged.
+        with open(self.journal_path, 'a') as journal:
+            journal.write('{"instance":{"inline_message_id":"mes')
+
+        with self.assertLogs('write_behind', 'WARNING'):
+            poll = self.restart()
+        self.assertEqual(poll['votes'], {'1': 0, '2': 1})
+
+    def test_recover_after_failed_flush(self):
+        self.vote('1', 0)
+        self.vote('2', 1)
+        storage = self.bot.storage
+
+        def write_instance(row):
+            raise RuntimeError("database is gone")
+
+        storage.write_instance, working_write_instance = write_instance, storage.write_instance
+        with self.assertRaises(RuntimeError):
+            self.bot.write_behind.flush()
+        storage.write_instance = working_write_instance
+        self.assertTrue(os.path.exists(self.journal_path + '.flushing'))
+        self.assertIsNone(storage.get_instance(MESSAGE))
+
+        # Votes after the failed flush go to a new journal file next to the .flushing one.
+        self.vote('3', 0)
+        self.vote('1', 1)
+
+        poll = self.restart()
+        self.assertEqual(poll['votes'], {'1': 1, '2': 1, '3': 0})
+        self.assertFalse(os.path.exists(self.journal_path + '.flushing'))
+
+    def test_replay_of_written_votes(self):
+        self.vote('1', 0)
+        self.vote('2', 1)
+        self.vote('2', 0)
+        with open(self.journal_path, 'r') as journal:
+            entries = journal.read()
+        self.bot.write_behind.flush()
+        written = self.stored_poll()
+
+        # The process died after the flush committed, but before the journal was released.
+        with open(self.journal_path, 'a') as journal:
+            journal.write(entries)
+
+        poll = self.restart()
+        self.assertEqual(poll['votes'], written['votes'])
+        self.assertEqual(poll['votes'], {'1': 0, '2': 0})
+        self.assertEqual(poll['tally'], written['tally'])
+
+
+if __name__ == '__main__':
+    unittest.main()
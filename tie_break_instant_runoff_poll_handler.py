@@ -1,5 +1,5 @@
 from base_poll_handler import *
-import math
+from instant_runoff_poll_handler import count_rounds
 
 
 name = "Instant runoff poll with fallback tie-breaking"
@@ -46,63 +46,44 @@ def evaluation(poll):
     candidates = [opt['index'] for opt in poll['options']]
 
     if votes:
-        elected = None
-        quota = math.floor(len(votes) / 2) + 1
-
-        while elected is None:
-            counts = count_votes(votes, candidates)
-            max_votes = max(counts)
-            if max_votes >= quota:
-                # Somebody has hit the quota, elect them:
-                elected = [candidates[i] for i, count in enumerate(counts) if count == max_votes]
-            else:
-                min_votes = min(counts)
-                old_candidates = list(candidates)
-                # eliminate all candidates with lowest count:
-                delete_pls = []
-                for i, count in enumerate(counts):
-                    if count == min_votes:
-                        delete_pls.append(candidates[i])
-                for candidate in delete_pls:
-                    candidates.remove(candidate)
-                if not candidates:
-                    # The last remaining candidates were eliminated at the same time. We have a tie!
-                    candidates = old_candidates
-                    # Tiebreak fallback solution
-                    tiered_votes = {}
-                    for candidate in old_candidates:
-                        tiered_vote = get_votes_per_rank(poll, candidate)
-                        tiered_votes[candidate] = tiered_vote
-
-                    for i in range(1, len(poll['options']) + 1):
-                        # To resolve the tie, continually calculate prefix sums of our the votes per rank
-                        max_candidate_vote = 0
-                        current_best_candidates = []
-                        for candidate, vote in tiered_votes.items():
-                            prefix_sum = sum(vote[:i])
-                            # Keep all candidates with highest prefix sum
-                            if max_candidate_vote == prefix_sum:
-                                current_best_candidates.append(candidate)
-                            elif max_candidate_vote < prefix_sum:
-                                max_candidate_vote = prefix_sum
-                                current_best_candidates = [candidate]
-
-                        # Throw out all candidates that don't have highest prefix sum anymore
-                        to_remove = []
-                        for candidate, vote in tiered_votes.items():
-                            if candidate not in current_best_candidates:
-                                to_remove.append(candidate)
-                        for candidate in to_remove:
-                            tiered_votes.pop(candidate)
-
-                        if len(current_best_candidates) == 1:
-                            # we have a winner!
-                            elected = current_best_candidates
-                            break
-
-                    if not elected:
-                        # We have a true tie
-                        elected = current_best_candidates
+        elected, tied = count_rounds(candidates, list(votes.values()))
+        if elected is None:
+            # The last remaining candidates were eliminated at the same time. We have a tie!
+            # Tiebreak fallback solution
+            tiered_votes = {}
+            for candidate in tied:
+                tiered_vote = get_votes_per_rank(poll, candidate)
+                tiered_votes[candidate] = tiered_vote
+
+            for i in range(1, len(poll['options']) + 1):
+                # To resolve the tie, continually calculate prefix sums of our the votes per rank
+                max_candidate_vote = 0
+                current_best_candidates = []
+                for candidate, vote in tiered_votes.items():
+                    prefix_sum = sum(vote[:i])
+                    # Keep all candidates with highest prefix sum
+                    if max_candidate_vote == prefix_sum:
+                        current_best_candidates.append(candidate)
+                    elif max_candidate_vote < prefix_sum:
+                        max_candidate_vote = prefix_sum
+                        current_best_candidates = [candidate]
+
+                # Throw out all candidates that don't have highest prefix sum anymore
+                to_remove = []
+                for candidate, vote in tiered_votes.items():
+                    if candidate not in current_best_candidates:
+                        to_remove.append(candidate)
+                for candidate in to_remove:
+                    tiered_votes.pop(candidate)
+
+                if len(current_best_candidates) == 1:
+                    # we have a winner!
+                    elected = current_best_candidates
+                    break
+
+            if not elected:
+                # We have a true tie
+                elected = current_best_candidates
 
         elected_names = [get_option_name_by_index(poll, el) for el in elected]
         message = "{}: {}".format(
@@ -123,15 +104,8 @@ def evaluation(poll):
     return body
 
 
-def count_votes(votes, candidates):
-    counts = [0] * len(candidates)
-    for vote in votes.values():
-        vote_counted = False
-        for preference in vote:
-            if preference in candidates and not vote_counted:
-                counts[candidates.index(preference)] += 1
-                vote_counted = True
-    return counts
+def accepts_press(callback_data):
+    return is_option_press(callback_data, special=('C',))
 
 
 def handle_vote(votes, user, name, callback_data):
@@ -153,6 +127,10 @@ def handle_vote(votes, user, name, callback_data):
         votes[user] = old_vote
 
 
+def export_vote(vote):
+    return [{'option': index, 'rank': rank} for rank, index in enumerate(vote, start=1)]
+
+
 def get_confirmation_message(poll, user):
     votes = poll['votes']
     if user in votes:
@@ -0,0 +1,182 @@
+"""Where the votes of a poll instance are kept.
+
+JsonVoteStorage keeps all votes of an instance as one JSON document in
+``setpoll_instances.votes``, and reads them back from the votes table for
+instances that were stored there before. TableVoteStorage keeps one row per
+voter in the ``votes`` table, so a button press only reads and writes the row
+of the voter who pressed it. Handlers see the votes of either as a mapping
+from user id to vote.
+"""
+import json
+from collections import Counter
+from collections.abc import MutableMapping
+
+VOTES_TABLE = 'votes'
+
+
+class JsonVoteStorage:
+    name = 'json'
+
+    def __init__(self):
+        # Instances whose votes were read back from the votes table, see attach().
+        self.moved_back = set()
+
+    def attach(self, db, poll):
+        # Instances stored with the table storage have an empty JSON column. If the
+        # storage was switched back, their votes are moved back with the next write.
+        if poll.get('votes') or poll.get('id') is None or not db.has_table(VOTES_TABLE):
+            return
+        votes = {row['user_id']: json.loads(row['payload'])
+                 for row in db[VOTES_TABLE].find(instance_id=poll['id'])}
+        if votes:
+            poll['votes'] = votes
+            self.moved_back.add(poll['id'])
+
+    def dump(self, votes):
+        return json.dumps(votes)
+
+    def write(self, db, poll):
+        if poll['id'] in self.moved_back:
+            # The JSON column written in the same transaction holds the votes from now on.
+            db[VOTES_TABLE].delete(instance_id=poll['id'])
+            self.moved_back.discard(poll['id'])
+
+
+class TableVoteStorage:
+    name = 'table'
+
+    def attach(self, db, poll):
+        # Votes still stored in the JSON column are moved to the table with the next write.
+        legacy = poll.get('votes') or {}
+        poll['votes'] = VoteTable(db, poll.get('id'), legacy)
+
+    def dump(self, votes):
+        return '{}'
+
+    def write(self, db, poll):
+        poll['votes'].write(db, poll['id'])
+
+
+class VoteTable(MutableMapping):
+    """The votes of one poll instance, loaded from the votes table as they are needed."""
+
+    def __init__(self, db, instance_id, legacy=None):
+        self.db = db
+        self.instance_id = instance_id
+        self.cache = dict(legacy or {})
+        self.stored = {}
+        self.absent = set()
+        self.dirty = set(self.cache)
+        # A new instance, or one whose votes are still in the JSON column, has no rows yet.
+        self.complete = instance_id is None or bool(legacy)
+
+    def __getitem__(self, user):
+        self._load_user(user)
+        return self.cache[user]
+
+    def __setitem__(self, user, vote):
+        self._load_user(user)
+        self.cache[user] = vote
+        self.absent.discard(user)
+        self.dirty.add(user)
+
+    def __delitem__(self, user):
+        self._load_user(user)
+        del self.cache[user]
+        self.absent.add(user)
+        self.dirty.add(user)
+
+    def __contains__(self, user):
+        self._load_user(user)
+        return user in self.cache
+
+    def __iter__(self):
+        self._load_all()
+        return iter(self.cache)
+
+    def __len__(self):
+        if self.complete:
+            return len(self.cache)
+        rows = self.db.query('SELECT COUNT(*) AS num FROM {} WHERE instance_id = :instance_id'.format(VOTES_TABLE),
+                             instance_id=self.instance_id)
+        num = next(iter(rows))['num']
+        for user in self.dirty:
+            num += (user in self.cache) - (user in self.stored)
+        return num
+
+    def grouped(self):
+        """Yield (vote, number of voters who cast it) pairs, aggregated by the database."""
+        if self.complete:
+            for vote in self.cache.values():
+                yield vote, 1
+            return
+
+        counts = Counter()
+        rows = self.db.query('SELECT payload, COUNT(*) AS num FROM {} WHERE instance_id = :instance_id '
+                             'GROUP BY payload'.format(VOTES_TABLE),
+                             instance_id=self.instance_id)
+        for row in rows:
+            counts[row['payload']] += row['num']
+        for user in self.dirty:
+            if user in self.stored:
+                counts[self.stored[user]] -= 1
+            if user in self.cache:
+                counts[json.dumps(self.cache[user])] += 1
+
+        for payload, num in counts.items():
+            if num > 0:
+                yield json.loads(payload), num
+
+    def write(self, db, instance_id):
+        table = db[VOTES_TABLE]
+        for user in self.dirty:
+            if user in self.cache:
+                table.upsert({
+                    'instance_id': instance_id,
+                    'user_id': user,
+                    'payload': json.dumps(self.cache[user]),
+                }, ['instance_id', 'user_id'])
+            elif user in self.stored:
+                table.delete(instance_id=instance_id, user_id=user)
+        for user in self.dirty:
+            if user in self.cache:
+                self.stored[user] = json.dumps(self.cache[user])
+            else:
+                self.stored.pop(user, None)
+        self.instance_id = instance_id
+        self.dirty = set()
+
+    def _load_user(self, user):
+        if self.complete or user in self.cache or user in self.absent:
+            return
+        row = self.db[VOTES_TABLE].find_one(instance_id=self.instance_id, user_id=user)
+        if row is None:
+            self.absent.add(user)
+        else:
+            self.stored[user] = row['payload']
+            self.cache[user] = json.loads(row['payload'])
+
+    def _load_all(self):
+        if self.complete:
+            return
+        for row in self.db[VOTES_TABLE].find(instance_id=self.instance_id):
+            user = row['user_id']
+            if user in self.dirty:
+                continue
+            self.stored[user] = row['payload']
+            self.cache[user] = json.loads(row['payload'])
+        self.complete = True
+
+
+def grouped_payloads(votes):
+    """Yield (vote, number of voters who cast it) pairs for the votes of an instance, in either storage."""
+    if isinstance(votes, VoteTable):
+        # Votes stored in their own table are aggregated by the database.
+        return votes.grouped()
+    return ((vote, 1) for vote in votes.values())
+
+
+VOTE_STORAGES = {
+    JsonVoteStorage.name: JsonVoteStorage,
+    TableVoteStorage.name: TableVoteStorage,
+}
@@ -0,0 +1,100 @@
+"""Incrementally maintained per-option vote counts for poll instances.
+
+Poll handlers opt in by implementing ``selected_options(vote)``, which maps a
+single cast vote to the list of option indices it counts towards. The tally
+is stored next to ``votes`` on the instance as
+``{'voters': <number of votes>, 'counts': [<count per option>, ...]}``.
+"""
+import logging
+
+import vote_storage
+
+logger = logging.getLogger(__name__)
+
+# Tallies are counted again from the votes on every this many versions of an instance.
+RECOUNT_INTERVAL = 100
+
+
+def supports_tally(handler):
+    return handler.selected_options(None) is not None
+
+
+def build(poll, handler):
+    counts = [0] * len(poll['options'])
+    votes = poll.get('votes', {})
+
+    voters = 0
+    for vote, num in vote_storage.grouped_payloads(votes):
+        voters += num
+        for i in handler.selected_options(vote):
+            if 0 <= i < len(counts):
+                counts[i] += num
+    return {
+        'voters': voters,
+        'counts': counts,
+    }
+
+
+def looks_consistent(poll, handler):
+    """Check the tally against what can be told about the votes without counting them.
+
+    The tally needs a count per option, as many voters as there are votes, and
+    no option counted more often than there are voters. For single choice poll
+    types the counts also add up to the voters. Counts that drifted apart in a
+    way that keeps all of that true are caught by the recount in ensure().
+    """
+    tally = poll.get('tally')
+    if not tally:
+        return False
+    counts = tally.get('counts', [])
+    if len(counts) != len(poll['options']):
+        return False
+    voters = tally.get('voters')
+    # For votes kept in their own table this is a COUNT(*) on the instance's rows.
+    if voters != len(poll.get('votes', {})):
+        return False
+    if any(count < 0 or count > voters for count in counts):
+        return False
+    return not handler.single_choice or sum(counts) == voters
+
+
+def ensure(poll, handler):
+    """Make sure the poll carries a tally that agrees with its votes, rebuilding it if it doesn't."""
+    if not supports_tally(handler):
+        return
+    if not looks_consistent(poll, handler):
+        poll['tally'] = build(poll, handler)
+        return
+    version = poll.get('version')
+    if version and version % RECOUNT_INTERVAL == 0:
+        # Every so often the tally is counted again from the votes, for drift the checks above can't see.
+        tally = build(poll, handler)
+        if tally != poll['tally']:
+            logger.warning("Tally of instance %s drifted from its votes, rebuilt it", poll.get('id'))
+            poll['tally'] = tally
+
+
+def update(poll, handler, old_vote, new_vote):
+    """Apply the difference between a voter's old and new vote to the poll's tally."""
+    if not supports_tally(handler) or not poll.get('tally'):
+        return
+    tally = poll['tally']
+    counts = tally['counts']
+    if old_vote is not None:
+        tally['voters'] -= 1
+        for i in handler.selected_options(old_vote):
+            if 0 <= i < len(counts):
+                counts[i] -= 1
+    if new_vote is not None:
+        tally['voters'] += 1
+        for i in handler.selected_options(new_vote):
+            if 0 <= i < len(counts):
+                counts[i] += 1
+
+
+def count(poll, index):
+    """Return the tallied count for an option, or None if the poll has no tally."""
+    tally = poll.get('tally')
+    if not tally:
+        return None
+    return tally['counts'][index]
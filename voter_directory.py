@@ -0,0 +1,88 @@
+"""The names of the voters on open polls, stored once per poll instance.
+
+Open polls show who voted for what. Their votes used to carry the voter's
+first name, as ``{'data': <option>, 'name': <name>}``. Now they have the same
+shape as the votes of basic and multiple options polls, and the names are
+kept in the instance's voter directory instead:
+
+    {'names': {<name>: <id>, ...}, 'ids': {<user id>: <name id>, ...}, 'next': <next name id>}
+
+A name shared by several voters is stored once. Votes in the old format are
+still read, and are converted when their voter votes again.
+"""
+from collections import Counter, defaultdict
+
+# How many characters of names the voter lists of a message may take up, so it
+# stays below Telegram's limit of 4096 characters together with the rest of the poll.
+MAX_NAMES_LENGTH = 3000
+
+UNKNOWN_NAME = "Somebody"
+
+
+def vote_data(vote):
+    """Return the option(s) of a vote, in either format."""
+    return vote['data'] if isinstance(vote, dict) else vote
+
+
+def update(poll, user, name):
+    """Record the name of a voter after they voted, or forget them once they have no vote left."""
+    directory = poll.get('voters')
+    if directory is None:
+        directory = poll['voters'] = {'names': {}, 'ids': {}, 'next': 0}
+    ids = directory['ids']
+    if user not in poll['votes']:
+        ids.pop(user, None)
+        return
+    if name is None:
+        # Keep what's known, for example when replaying a journal without names.
+        return
+
+    names = directory['names']
+    name_id = names.get(name)
+    if name_id is None:
+        name_id = names[name] = directory['next']
+        directory['next'] += 1
+    ids[user] = name_id
+
+    if len(names) > 2 * len(ids) + 16:
+        compact(directory)
+
+
+def compact(directory):
+    """Drop the names nobody who voted has anymore."""
+    used = set(directory['ids'].values())
+    directory['names'] = {name: name_id for name, name_id in directory['names'].items() if name_id in used}
+
+
+def names_by_id(directory):
+    return {name_id: name for name, name_id in (directory or {}).get('names', {}).items()}
+
+
+def voter_name(directory, names, user, vote):
+    """Return a voter's name, given the directory and its names_by_id()."""
+    if isinstance(vote, dict):
+        return vote['name']
+    return names.get((directory or {}).get('ids', {}).get(user), UNKNOWN_NAME)
+
+
+def names_by_option(poll, selected_options, max_length=None):
+    """Group the voters' names by the options they voted for, in a single pass over the votes.
+
+    Once the names listed for an option take up max_length characters, the
+    remaining voters of that option are only counted, without looking up their
+    names. Returns the lists of names and the numbers of voters left out, by option index.
+    """
+    directory = poll.get('voters')
+    names = names_by_id(directory)
+    grouped = defaultdict(list)
+    lengths = Counter()
+    hidden = Counter()
+    for user, vote in poll.get('votes', {}).items():
+        for index in selected_options(vote):
+            if max_length is not None and lengths[index] >= max_length:
+                hidden[index] += 1
+                continue
+            name = voter_name(directory, names, user, vote)
+            grouped[index].append(name)
+            lengths[index] += len(name) + 2
+    return grouped, hidden
@@ -0,0 +1,121 @@
+"""Receives updates from Telegram through a webhook instead of long polling.
+
+Telegram POSTs every update to the configured path, and the updates are put on
+the dispatcher's update queue, where they are handled exactly like polled ones.
+With an AsyncPollBot, button presses and inline queries are instead handled
+on the server's event loop. Requests that don't carry the configured secret token are rejected, so only
+Telegram (or replay_updates.py) can feed updates to the bot.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import threading
+from collections import Counter
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ('POST',)
+
+    def initialize(self, bot, update_queue, secret_token, counters, async_bot):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.async_bot = async_bot
+        self.secret_token = secret_token
+        self.counters = counters
+
+    def post(self):
+        if self.secret_token:
+            token = self.request.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                self.counters['rejected'] += 1
+                raise tornado.web.HTTPError(403)
+
+        try:
+            data = json.loads(self.request.body.decode())
+        except ValueError:
+            self.counters['malformed'] += 1
+            raise tornado.web.HTTPError(400)
+
+        update = Update.de_json(data, self.bot)
+        if update:
+            if self.async_bot is not None and self.async_bot.handles(update):
+                # Handled on this event loop, Telegram doesn't wait for the outcome.
+                IOLoop.current().spawn_callback(self.async_bot.process, update)
+            else:
+                self.update_queue.put(update)
+            self.counters['received'] += 1
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class WebhookServer:
+    def __init__(self, bot, update_queue, listen='127.0.0.1', port=8443, path='/', secret_token=None,
+                 async_bot=None):
+        self.bot = bot
+        self.listen = listen
+        self.port = port
+        self.path = '/' + path.strip('/')
+        self.counters = Counter()
+        self.application = tornado.web.Application([
+            (r'{}/?'.format(self.path.rstrip('/')), UpdateHandler, {
+                'bot': bot,
+                'update_queue': update_queue,
+                'secret_token': secret_token,
+                'counters': self.counters,
+                'async_bot': async_bot,
+            }),
+        ], log_function=lambda handler: None)
+        self.loop = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, name='webhook', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        logger.info("Listening for updates on %s:%s%s", self.listen, self.port, self.path)
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.add_callback(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+
+    def _serve(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.loop = IOLoop.current()
+        server = HTTPServer(self.application)
+        server.listen(self.port, address=self.listen)
+        self.ready.set()
+        self.loop.start()
+        server.stop()
+
+
+def set_webhook(bot, url, secret_token=None, max_connections=40):
+    """Tell Telegram where to send updates."""
+    api_kwargs = {'secret_token': secret_token} if secret_token else None
+    bot.set_webhook(url=url, max_connections=max_connections, api_kwargs=api_kwargs)
+    logger.info("Webhook set to %s", url)
+
+
+def wait_for_stop_signal(stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+    """Block until the process receives one of the stop signals, like Updater.idle() does for polling."""
+    stop = threading.Event()
+    for sig in stop_signals:
+        signal.signal(sig, lambda signum, frame: stop.set())
+    while not stop.is_set():
+        stop.wait(1)
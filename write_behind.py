@@ -0,0 +1,244 @@
+"""Keeps busy poll instances in memory and writes them to the database in batches.
+
+Every vote is appended to a journal file and fsynced before the click is
+acknowledged, then applied to the in-memory instance. A background thread
+writes all changed instances in one transaction every ``interval`` seconds, or
+sooner once ``max_dirty`` instances are waiting. Journal entries hold the
+voter's vote after the click rather than the click itself, so replaying them
+at startup restores every acknowledged vote no matter how many of them were
+written already.
+
+Only one bot process may use write-behind on a database, since instances are
+written without checking for concurrent writers.
+"""
+import copy
+import json
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+
+import vote_tally
+
+logger = logging.getLogger(__name__)
+
+
+def message_key(instance_kwargs):
+    if 'inline_message_id' in instance_kwargs:
+        return instance_kwargs['inline_message_id']
+    return instance_kwargs['chat_id'], instance_kwargs['message_id']
+
+
+class Journal:
+    """An append-only file of JSON entries. Concurrent appends share fsyncs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.flushing_path = path + '.flushing'
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.file = open(self.path, 'a')
+        self.written = 0
+        self.synced = 0
+
+    def append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.file.flush()
+            self.written += 1
+            seq = self.written
+        with self.sync_lock:
+            if self.synced >= seq:
+                # Somebody else's fsync already covered this entry.
+                return
+            with self.lock:
+                target = self.written
+                fd = self.file.fileno()
+            os.fsync(fd)
+            self.synced = target
+
+    def entries(self):
+        """Yield the entries not yet known to be written to the database, oldest first."""
+        for path in (self.flushing_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as infile:
+                for line in infile:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the file, the click was never acknowledged.
+                        logger.warning("Skipping damaged journal entry in %s", path)
+
+    def rotate(self):
+        """Start a new journal file. The entries so far are kept until release() is called."""
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if os.path.exists(self.flushing_path):
+                # The previous flush failed, so its entries are still needed.
+                with open(self.path, 'r') as current, open(self.flushing_path, 'a') as flushing:
+                    flushing.write(current.read())
+                    flushing.flush()
+                    os.fsync(flushing.fileno())
+                os.remove(self.path)
+            else:
+                os.rename(self.path, self.flushing_path)
+            self.file = open(self.path, 'a')
+            self.synced = self.written
+
+    def release(self):
+        """Drop the entries from before the last rotate(), they're in the database now."""
+        if os.path.exists(self.flushing_path):
+            os.remove(self.flushing_path)
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.file.close()
+
+
+class WriteBehind:
+    def __init__(self, pollbot, journal_path, interval=1.0, max_dirty=500, max_instances=10000):
+        self.pollbot = pollbot
+        self.journal = Journal(journal_path)
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.max_instances = max_instances
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.instances = OrderedDict()
+        self.dirty = set()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.counters = Counter()
+
+    def apply_vote(self, instance_kwargs, poll_id, user, name, data_dict):
+        """Record a vote on a poll instance and return the updated poll.
+
+        The caller must hold the instance's lock, and keep holding it while reading the poll.
+        """
+        key = message_key(instance_kwargs)
+        poll = self.get_instance(key, instance_kwargs, poll_id)
+        with self.pollbot.metrics.phase('compute'):
+            new_vote = self.pollbot.cast_vote(poll, user, name, data_dict)
+        poll['version'] += 1
+        # Marked before journaling, so a flush that drops the journal entry also writes the vote.
+        self.mark_dirty(key)
+
+        with self.pollbot.metrics.phase('db_write'):
+            self.journal.append({
+                'instance': instance_kwargs,
+                'poll_id': poll_id,
+                'user': user,
+                'name': name,
+                'vote': new_vote,
+            })
+        self.counters['votes'] += 1
+        return poll
+
+    def get_instance(self, key, instance_kwargs, poll_id):
+        with self.lock:
+            poll = self.instances.get(key)
+            if poll is not None:
+                self.instances.move_to_end(key)
+                return poll
+        poll = self.pollbot.load_instance(instance_kwargs, poll_id)
+        vote_tally.ensure(poll, self.pollbot.get_handler(poll))
+        with self.lock:
+            self.instances[key] = poll
+            self._evict()
+        return poll
+
+    def mark_dirty(self, key):
+        with self.lock:
+            self.dirty.add(key)
+            if len(self.dirty) >= self.max_dirty:
+                self.wakeup.set()
+
+    def recover(self):
+        """Apply the votes left in the journal by a previous run and write them to the database."""
+        replayed = 0
+        for entry in self.journal.entries():
+            instance_kwargs = entry['instance']
+            key = message_key(instance_kwargs)
+            poll = self.get_instance(key, instance_kwargs, entry['poll_id'])
+            handler = self.pollbot.get_handler(poll)
+
+            votes = poll['votes']
+            user = entry['user']
+            old_vote = copy.deepcopy(votes.get(user))
+            if entry['vote'] is None:
+                votes.pop(user, None)
+            else:
+                votes[user] = entry['vote']
+            handler.update_voter(poll, user, entry.get('name'))
+            vote_tally.update(poll, handler, old_vote, entry['vote'])
+            poll['version'] += 1
+            self.mark_dirty(key)
+            replayed += 1
+        if replayed:
+            logger.info("Replayed %s votes from the journal", replayed)
+        self.flush()
+
+    def flush(self):
+        """Write all changed instances to the database in a single transaction."""
+        with self.flush_lock:
+            self.journal.rotate()
+            with self.lock:
+                keys = self.dirty
+                self.dirty = set()
+            if not keys:
+                self.journal.release()
+                return 0
+
+            try:
+                with self.pollbot.storage.transaction() as tx:
+                    for key in keys:
+                        with self.pollbot.instance_locks.get(key):
+                            self._write(tx, self.instances[key])
+            except Exception:
+                with self.lock:
+                    self.dirty |= keys
+                self.counters['failed_flushes'] += 1
+                raise
+            self.journal.release()
+            self.counters['flushes'] += 1
+            self.counters['instances_written'] += len(keys)
+            with self.lock:
+                self._evict()
+            return len(keys)
+
+    def _write(self, tx, poll):
+        poll['id'] = self.pollbot.storage.write_instance(self.pollbot.serialize(poll))
+        self.pollbot.vote_storage.write(tx, poll)
+
+    def _evict(self):
+        # Must be called with the lock held. Instances with unwritten votes stay.
+        for key in list(self.instances):
+            if len(self.instances) <= self.max_instances:
+                break
+            if key not in self.dirty:
+                del self.instances[key]
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        self.journal.close()
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning('Writing votes to the database failed, retrying: "%s"', e)